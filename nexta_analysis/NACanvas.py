@@ -13,11 +13,14 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import math
 import threading
 import tkinter
 import typing
+from collections import OrderedDict
 from tkinter import Canvas
 
+import cv2
 import numpy as np
 from PIL import Image, ImageTk
 
@@ -25,6 +28,14 @@ WORKING_COLOR = "#00FF00"
 WORKING_WIDTH = 2
 POLY_COLOR = WORKING_COLOR
 POLY_WIDTH = WORKING_WIDTH
+# Size of the pieces the image is drawn in, in pixels of a pyramid level
+TILE_SIZE = 256
+# Most screen pixels per image pixel when zoomed in
+MAX_ZOOM = 16.0
+# Zoom change of each mouse wheel step
+ZOOM_STEP = 1.25
+# Tiles kept drawn, as a multiple of the tiles it takes to cover the canvas
+TILE_CACHE_FACTOR = 2
 
 
 def method_debounce(method, wait):
@@ -41,16 +52,64 @@ def method_debounce(method, wait):
     return debounced
 
 
+class ImagePyramid:
+    """
+    Image at half, quarter, ... size, each level made when first needed and kept until the image changes.
+    """
+
+    def __init__(self, img):
+        """
+        :param img: Full size image, level 0
+        """
+        self.levels = {0: img}
+        self.height, self.width = img.shape[0:2]
+
+    def get_level_for_scale(self, scale):
+        """
+        :param scale: Screen pixels per image pixel
+        :return: Smallest level that still has at least one pixel per screen pixel
+        """
+        if scale >= 1:
+            return 0
+        level = int(math.floor(math.log2(1 / scale)))
+        # No smaller than a tile
+        while level > 0 and max(self.width, self.height) >> level < TILE_SIZE:
+            level -= 1
+        return level
+
+    def get_level(self, level):
+        """
+        :return: Image of the level, each pixel the mean of a 2^level square of the full image
+        :rtype: np.ndarray
+        """
+        if level not in self.levels:
+            # Area averaged straight from the full image, only levels that are looked at are kept
+            size = (max(1, self.width >> level), max(1, self.height >> level))
+            self.levels[level] = cv2.resize(self.levels[0], size, interpolation=cv2.INTER_AREA)
+        return self.levels[level]
+
+
 class NACanvas:
     """
     It is expected that any function call on the object is from the GUI Thread.
+    Shows the image fit to the canvas, mouse wheel zooms in at the cursor and dragging pans. Only the tiles of the image
+    in view are drawn, from a pyramid level close to the zoom.
     """
 
     def __init__(self, rt, parent):
         self.rt = rt
         self.__image: typing.Any(None, np.ndarray) = None
+        self.__pyramid: typing.Any(None, ImagePyramid) = None
         self.__parent = parent
+        # Screen pixels per image pixel
         self.__last_canvasscale = 1.0
+        # Canvas pixel position of the scaled image's top left corner is -view
+        self.__view = [0, 0]
+        # Scale follows the canvas size until the user zooms
+        self.__fit = True
+        self.__pan_start = None
+        # (level, tile x, tile y) -> PhotoImage, drawn at the current scale
+        self.__tiles = OrderedDict()
         self.__mode = 'view'
         self.__polygons = []
         self.__working_poly = []  # Current working Polygon
@@ -71,6 +130,14 @@ class NACanvas:
         self.__canvas.bind('<Motion>', self.on_motion)
         self.__canvas.bind('<ButtonRelease-1>', self.on_button1_release)
         self.__canvas.bind('<ButtonRelease-3>', self.on_button3_release)
+        self.__canvas.bind('<ButtonPress-1>', self.on_pan_start)
+        self.__canvas.bind('<B1-Motion>', self.on_pan_motion)
+        self.__canvas.bind('<ButtonPress-2>', self.on_pan_start)
+        self.__canvas.bind('<B2-Motion>', self.on_pan_motion)
+        # Windows and macOS give wheel deltas, X11 buttons 4 and 5
+        self.__canvas.bind('<MouseWheel>', self.on_mouse_wheel)
+        self.__canvas.bind('<Button-4>', self.on_mouse_wheel)
+        self.__canvas.bind('<Button-5>', self.on_mouse_wheel)
         self.__canvas.bind_all('<KeyPress-Escape>', self.on_key_esc)
 
     def __call(self, event, *args):
@@ -91,8 +158,7 @@ class NACanvas:
             return
         l = len(self.__working_poly)
         if l > 0:
-            s = self.__last_canvasscale
-            self.__working_poly[l - 1] = [int(event.x / s), int(event.y / s)]
+            self.__working_poly[l - 1] = self.canvas_to_image(event.x, event.y)
             # print('on_motion', self.__working_poly[l - 1], event.x, event.y)
             self.draw_working_lastline()
 
@@ -100,13 +166,16 @@ class NACanvas:
         # print('Release', event.x, event.y)
         if self.__mode != 'roi':
             return
+        if self.__pan_start is not None and self.__pan_start[2]:
+            # Was a drag, not a click
+            return
         l = len(self.__working_poly)
-        s = self.__last_canvasscale
+        point = self.canvas_to_image(event.x, event.y)
         if l > 0:
-            self.__working_poly[l - 1] = [int(event.x / s), int(event.y / s)]
+            self.__working_poly[l - 1] = point
         else:
-            self.__working_poly.append([int(event.x / s), int(event.y / s)])
-        self.__working_poly.append([int(event.x / s), int(event.y / s)])
+            self.__working_poly.append(point)
+        self.__working_poly.append(list(point))
         self.draw_working_polygon()
 
     def on_button3_release(self, event):
@@ -126,6 +195,77 @@ class NACanvas:
             self.__mode = 'view'
             self.__call('<ROISDone>', polygons)
 
+    def on_pan_start(self, event):
+        # x, y and if it moved enough to be a drag
+        self.__pan_start = [event.x, event.y, False]
+
+    def on_pan_motion(self, event):
+        if self.__image is None or self.__pan_start is None:
+            return
+        dx = event.x - self.__pan_start[0]
+        dy = event.y - self.__pan_start[1]
+        if not self.__pan_start[2] and abs(dx) + abs(dy) < 4:
+            return
+        self.__pan_start = [event.x, event.y, True]
+        self.__view = [self.__view[0] - dx, self.__view[1] - dy]
+        self.draw_image()
+
+    def on_mouse_wheel(self, event):
+        if self.__image is None:
+            return
+        if event.num == 5 or event.delta < 0:
+            self.zoom(1 / ZOOM_STEP, event.x, event.y)
+        else:
+            self.zoom(ZOOM_STEP, event.x, event.y)
+
+    def get_fit_scale(self):
+        """
+        :return: Scale that fits the whole image on the canvas
+        """
+        return min(self.__canvas.winfo_width() / self.__pyramid.width,
+                   self.__canvas.winfo_height() / self.__pyramid.height)
+
+    def zoom(self, factor, x, y):
+        """
+        Zooms keeping the image point under canvas x, y in place. Zooming out all the way fits the image to the canvas
+        again.
+        :param factor: Amount to multiply the scale by
+        :param x: Canvas x
+        :param y: Canvas y
+        """
+        fit_scale = self.get_fit_scale()
+        scale = min(max(self.__last_canvasscale * factor, fit_scale), max(MAX_ZOOM, fit_scale))
+        if scale == self.__last_canvasscale:
+            return
+        ix, iy = self.canvas_to_image(x, y, False)
+        self.__fit = scale == fit_scale
+        self.__set_scale(scale)
+        self.__view = [int(round(ix * scale - x)), int(round(iy * scale - y))]
+        self.draw_image()
+
+    def canvas_to_image(self, x, y, whole=True):
+        """
+        :param x: Canvas x
+        :param y: Canvas y
+        :param whole: Give the image pixel the point is in, instead of float coordinates
+        :return: Image x, y
+        """
+        s = self.__last_canvasscale
+        ix = (x + self.__view[0]) / s
+        iy = (y + self.__view[1]) / s
+        if whole:
+            return [int(math.floor(ix)), int(math.floor(iy))]
+        return [ix, iy]
+
+    def image_to_canvas(self, points):
+        """
+        :param points: Image x, y points, (N, 2)
+        :return: Canvas coordinates of the points flattened, x1, y1, x2, y2, ...
+        :rtype: List[float]
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return (points * self.__last_canvasscale - self.__view).flatten().tolist()
+
     def set_roi_mode(self, enabled):
         if enabled:
             self.__mode = 'roi'
@@ -133,16 +273,18 @@ class NACanvas:
             self.on_key_esc()
 
     def set_image(self, img):
+        if self.__image is None or img is None or self.__image.shape != img.shape:
+            self.__fit = True
         self.__image = img
+        self.__pyramid = ImagePyramid(img) if img is not None else None
+        self.__tiles.clear()
 
     def draw_polygons(self):
         self.__canvas.delete('polygons')
         if self.__mode != 'roi':
             return
-        s = self.__last_canvasscale
         for polygon in self.__polygons:
-            adj_poly = np.array(s * np.array(polygon).flatten(), dtype=np.uint32).tolist()
-            p = self.__canvas.create_polygon(np.array(adj_poly).flatten().tolist(), outline=POLY_COLOR, width=POLY_WIDTH, fill='')
+            p = self.__canvas.create_polygon(self.image_to_canvas(polygon), outline=POLY_COLOR, width=POLY_WIDTH, fill='')
             self.__canvas.itemconfig(p, tags=('polygons',))
         self.draw_working_polygon()
 
@@ -153,10 +295,9 @@ class NACanvas:
         # Now our current working partial polygon
         l = len(self.__working_poly)
         if l > 1:
-            s = self.__last_canvasscale
             p1 = self.__working_poly[l - 2]
             p2 = self.__working_poly[l - 1]
-            points = np.array(s * np.array([p1, p2]).flatten(), dtype=np.uint32).tolist()
+            points = self.image_to_canvas([p1, p2])
             # print('dwll', points)
             l = self.__canvas.create_line(*points, width=WORKING_WIDTH, fill=WORKING_COLOR)
             tags = ('polygons', 'working', 'lastline')
@@ -166,13 +307,12 @@ class NACanvas:
         self.__canvas.delete('working')
         if self.__mode != 'roi':
             return
-        s = self.__last_canvasscale
         # Now our current working partial polygon
         for idx in range(1, len(self.__working_poly)):
             # print('draw_working_polygon', len(self.__working_poly), idx)
             p1 = self.__working_poly[idx - 1]
             p2 = self.__working_poly[idx]
-            points = np.array(s * np.array([p1, p2]).flatten(), dtype=np.uint32).tolist()
+            points = self.image_to_canvas([p1, p2])
             l = self.__canvas.create_line(*points, fill=WORKING_COLOR, width=WORKING_WIDTH)
             tags = ('polygons', 'working')
             if idx == len(self.__working_poly) - 1:
@@ -183,25 +323,84 @@ class NACanvas:
         self.draw_polygons()
         self.draw_working_polygon()
 
-    def refresh_canvas(self):
+    def __set_scale(self, scale):
+        if scale != self.__last_canvasscale:
+            # Tiles are drawn for one scale
+            self.__tiles.clear()
+        self.__last_canvasscale = scale
+
+    def __clamp_view(self):
+        """
+        Keeps the image on the canvas, an image smaller than the canvas is at the top left.
+        """
+        s = self.__last_canvasscale
+        for axis, (size, canvas_size) in enumerate(((self.__pyramid.width, self.__canvas.winfo_width()),
+                                                    (self.__pyramid.height, self.__canvas.winfo_height()))):
+            self.__view[axis] = int(min(max(self.__view[axis], 0), max(0, round(size * s) - canvas_size)))
+
+    def __get_tile(self, level, tx, ty):
+        """
+        :return: PhotoImage of a tile of a pyramid level at the current scale, and its top left in scaled image pixels
+        """
+        img = self.__pyramid.get_level(level)
+        s = self.__last_canvasscale
+        # Image pixels per level pixel
+        rx = self.__pyramid.width / img.shape[1]
+        ry = self.__pyramid.height / img.shape[0]
+        x0, y0 = tx * TILE_SIZE, ty * TILE_SIZE
+        x1, y1 = min(x0 + TILE_SIZE, img.shape[1]), min(y0 + TILE_SIZE, img.shape[0])
+        # Tile edges rounded the same way for every tile, so neighbors meet without gaps
+        cx0, cy0 = int(round(x0 * rx * s)), int(round(y0 * ry * s))
+        cx1, cy1 = int(round(x1 * rx * s)), int(round(y1 * ry * s))
+        key = (level, tx, ty)
+        if key in self.__tiles:
+            self.__tiles.move_to_end(key)
+        else:
+            tile = Image.fromarray(np.ascontiguousarray(img[y0:y1, x0:x1]), mode='RGB')
+            # Zoomed in past full size shows each image pixel as a square
+            resample = Image.NEAREST if s * rx > 1 else Image.BILINEAR
+            tile = tile.resize((max(1, cx1 - cx0), max(1, cy1 - cy0)), resample)
+            self.__tiles[key] = ImageTk.PhotoImage(image=tile)
+        return self.__tiles[key], cx0, cy0
+
+    def draw_image(self):
+        """
+        Draws the tiles of the image that are on the canvas, then the polygons over them.
+        """
         if self.__image is None:
             return
+        self.__clamp_view()
+        s = self.__last_canvasscale
         cwidth = self.__canvas.winfo_width()
         cheight = self.__canvas.winfo_height()
-        # print('D: ', self.__state['image']['working'].shape)
-        img = Image.fromarray(self.__image, mode='RGB')
-        isize = img.size
-        wscale = cwidth / isize[0]
-        hscale = cheight / isize[1]
-        s = min([wscale, hscale])
-        self.__last_canvasscale = s
-        img = img.resize((int(s * isize[0]), int(s * isize[1])), Image.BICUBIC)
-        # print(img.size)
-        image = ImageTk.PhotoImage(image=img)
+        level = self.__pyramid.get_level_for_scale(s)
+        img = self.__pyramid.get_level(level)
+        # Scaled image pixels per tile
+        tile_width = TILE_SIZE * self.__pyramid.width / img.shape[1] * s
+        tile_height = TILE_SIZE * self.__pyramid.height / img.shape[0] * s
+        tx0 = max(0, int(self.__view[0] // tile_width))
+        ty0 = max(0, int(self.__view[1] // tile_height))
+        tx1 = min(int(math.ceil((self.__view[0] + cwidth) / tile_width)), -(-img.shape[1] // TILE_SIZE))
+        ty1 = min(int(math.ceil((self.__view[1] + cheight) / tile_height)), -(-img.shape[0] // TILE_SIZE))
         self.__canvas.delete('all')
-        self.__canvas.image = image
-        self.__canvas.create_image(0, 0, anchor='nw', image=image)
+        for ty in range(ty0, ty1):
+            for tx in range(tx0, tx1):
+                photo, x, y = self.__get_tile(level, tx, ty)
+                self.__canvas.create_image(x - self.__view[0], y - self.__view[1], anchor='nw', image=photo,
+                                           tags=('tiles',))
+        # Memory stays around what the canvas shows, no matter the image size
+        max_tiles = TILE_CACHE_FACTOR * max(1, (tx1 - tx0) * (ty1 - ty0))
+        while len(self.__tiles) > max_tiles:
+            self.__tiles.popitem(last=False)
         self.draw_polygons()
+
+    def refresh_canvas(self):
+        if self.__image is None:
+            return
+        if self.__fit:
+            self.__set_scale(self.get_fit_scale())
+            self.__view = [0, 0]
+        self.draw_image()
         self.__canvas.pack(fill=tkinter.BOTH, expand=True)
 
     def bind(self, event, cb):
@@ -15,29 +15,92 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import cv2
+import numpy as np
 
 ARUCO_DICT = cv2.aruco.DICT_4X4_50
+# Markers are found on an image halved until its longest side is at most this many pixels
+DETECT_MAX_SIZE = 2048
+# Largest half size of the full resolution window corners are refined in
+REFINE_MAX_WINDOW = 15
+
+# Built once by get_detector
+_detector = None
+
+
+def get_detector():
+    """
+    :return: ArucoDetector for our markers, created on first use
+    :rtype: cv2.aruco.ArucoDetector
+    """
+    global _detector
+    if _detector is None:
+        aruco_dict = cv2.aruco.getPredefinedDictionary(ARUCO_DICT)
+        aruco_params = cv2.aruco.DetectorParameters()
+        aruco_params.adaptiveThreshWinSizeStep = 5
+        aruco_params.adaptiveThreshWinSizeMax = 100
+        _detector = cv2.aruco.ArucoDetector(aruco_dict, aruco_params)
+    return _detector
+
+
+def markers_to_dict(corners, ids):
+    """
+    :param corners: Marker corners from detectMarkers
+    :param ids: Flat list of marker ids
+    :return: Dict of id to the corners and center of the marker
+    """
+    ret = {}
+    for (corner, id) in zip(corners, ids):
+        ret[id] = {
+            'corners': corner[0],
+            'center': [(corner[0][0][0] + corner[0][2][0]) / 2., (corner[0][0][1] + corner[0][2][1]) / 2.]
+        }
+    return ret
+
 
 def detect(image):
-    aruco_dict = cv2.aruco.getPredefinedDictionary(ARUCO_DICT)
-    aruco_params = cv2.aruco.DetectorParameters()
-    aruco_params.adaptiveThreshWinSizeStep=5
-    aruco_params.adaptiveThreshWinSizeMax=100
-    print(aruco_params)
-    detector = cv2.aruco.ArucoDetector(aruco_dict, aruco_params)
-
-    corners, ids, rejected = detector.detectMarkers(image)
-    # print(rejected)
-    if ids is not None:
-        ids = ids.flatten()
-        # print(corners)
-        # print(ids)
-        ret = {}
-        for (corner, id) in zip(corners, ids):
-            # print('id', id)
-            # print('corner', corner)
-            ret[id] = {
-                'corners': corner[0],
-                'center': [(corner[0][0][0]+corner[0][2][0])/2., (corner[0][0][1]+corner[0][2][1])/2.]
-           }
-    return ret, sorted(ids), [corners, ids]
+    """
+    Finds markers in the image at its full resolution.
+    :param image: uint8 grayscale image, black markers
+    :return: Dict of id to marker corners and center, sorted ids, [corners, ids] for drawing
+    """
+    corners, ids, rejected = get_detector().detectMarkers(image)
+    if ids is None:
+        return {}, [], [corners, ids]
+    flat_ids = [int(id) for id in ids.flatten()]
+    return markers_to_dict(corners, flat_ids), sorted(flat_ids), [corners, ids]
+
+
+def detect_pyramid(image, invert=False, blur=15, max_size=DETECT_MAX_SIZE):
+    """
+    Finds markers on a downsampled copy of the image, then refines their corners on the full resolution image in small
+    windows around each corner. Much faster than detect on large images, and only small copies of the image are made.
+    :param image: uint8 grayscale image
+    :param invert: Markers are white instead of black
+    :param blur: Gaussian blur kernel size at full resolution, scaled down with the image
+    :param max_size: Detect on an image no larger than this
+    :return: Same as detect, corners are in full resolution coordinates
+    """
+    small = image
+    factor = 1
+    while max(small.shape[0:2]) > max_size:
+        small = cv2.pyrDown(small)
+        factor *= 2
+    if invert:
+        small = 255 - small
+    ksize = max(blur // factor, 1) | 1
+    if ksize > 1:
+        small = cv2.GaussianBlur(small, (ksize, ksize), 0)
+    corners, ids, rejected = get_detector().detectMarkers(small)
+    if ids is None:
+        return {}, [], [corners, ids]
+    if factor > 1:
+        # Pixel centers of each pyramid level are at (x + 0.5) * factor - 0.5 in the full image
+        points = (np.concatenate([c.reshape(-1, 2) for c in corners]) + 0.5) * factor - 0.5
+        points = np.float32(points)
+        window = min(factor, REFINE_MAX_WINDOW)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+        # Gradients are the same for white or black markers, so no need to invert the full image
+        cv2.cornerSubPix(image, points, (window, window), (-1, -1), criteria)
+        corners = tuple(points.reshape(-1, 1, 4, 2))
+    flat_ids = [int(id) for id in ids.flatten()]
+    return markers_to_dict(corners, flat_ids), sorted(flat_ids), [corners, ids]
@@ -0,0 +1,172 @@
+# Exposure Timing - NEXTA Analysis
+# Copyright (C) 2024 Russell Valentine
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import glob
+import json
+import os
+import signal
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import read_time
+import result_store
+from running_stats import FrameStats, FRAME_STAT_KEYS
+
+FITS_EXTENSIONS = ('.fits', '.fit', '.fts')
+
+# Set in each worker process by init_worker
+_worker = {}
+
+
+def find_fits_files(fits_input):
+    """
+    :param fits_input: Directory with fits files, or glob pattern of fits files
+    :return: Sorted list of fits files
+    """
+    if os.path.isdir(fits_input):
+        fits_files = [os.path.join(fits_input, fn) for fn in os.listdir(fits_input)
+                      if os.path.splitext(fn)[1].lower() in FITS_EXTENSIONS]
+    else:
+        fits_files = glob.glob(fits_input)
+    return sorted(fits_files)
+
+
+def get_output_filename(fits_filename):
+    return os.path.splitext(fits_filename)[0] + '.ettime'
+
+
+def init_worker(registration, band_only, raw, store_path=None, write_json=True, track=False):
+    """
+    Keeps the registration and options in the worker, so they are only sent once per worker instead of per frame.
+    """
+    _worker['registration'] = registration
+    _worker['band_only'] = band_only
+    _worker['raw'] = raw
+    _worker['store'] = result_store.ResultStore(store_path) if store_path else None
+    _worker['write_json'] = write_json
+    _worker['track'] = track
+    # Ctrl-C is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def process_frame(fits_filename):
+    """
+    Reads time of a fits file in a worker and saves it next to the fits file and/or in the worker's result store.
+    :param fits_filename: fits file to read
+    :return: The summary values, shutter type and if the LED band drifted too far to track in the frame
+    :rtype: Dict[str, float]
+    """
+    output_fn = get_output_filename(fits_filename) if _worker['write_json'] else None
+    save_data = read_time.run(_worker['registration'], fits_filename, output_fn, band_only=_worker['band_only'],
+                              raw=_worker['raw'], store=_worker['store'], track=_worker['track'])
+    frame_summary = {key: save_data[key] for key in FRAME_STAT_KEYS}
+    frame_summary['shutter_type'] = save_data['shutter_type']
+    frame_summary['drift'] = save_data['tracking']['drift'] if save_data['tracking'] else None
+    return frame_summary
+
+
+def run_batch(registration, fits_files, workers=None, band_only=False, raw=False, verbose=0, frame_stats=None,
+              store_path=None, write_json=True, track=False):
+    """
+    Reads time from many fits files using a pool of processes.
+    :param registration: Registration, or path to a registration file
+    :param fits_files: List of fits files to read, results are saved in .ettime files next to them
+    :param workers: Number of processes, defaults to number of cpus
+    :param band_only: Only read and stretch the rows of the LED band
+    :param raw: Read time without stretching
+    :param verbose: How much output to print
+    :param frame_stats: FrameStats to add results to as frames finish, lets the caller look at stats mid-run
+    :param store_path: Result store file to add timing of each frame to
+    :param write_json: Save timing of each frame in an .ettime file
+    :param track: Correct small movement of the LED band since registration
+    :return: Summary of all frames that could be read
+    :rtype: Dict[str, Dict[str, float]]
+    """
+    if not isinstance(registration, read_time.Registration):
+        registration = read_time.Registration.load(registration)
+    if frame_stats is None:
+        frame_stats = FrameStats()
+    if store_path:
+        # Create the tables before workers open it
+        result_store.ResultStore(store_path).close()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(registration, band_only, raw, store_path, write_json, track)) as executor:
+        futures = {executor.submit(process_frame, fn): fn for fn in fits_files}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                frame_stats.add(future.result())
+            except Exception as e:
+                frame_stats.add_failed()
+                print()
+                print('Failed to read time:', futures[future])
+                if verbose >= 1:
+                    traceback.print_exception(e)
+            delta_stats = frame_stats.stats['fits_delta']
+            print(str(i + 1) + '/' + str(len(fits_files)), 'mean fits_delta:', delta_stats.mean, end='\r')
+    print()
+    return frame_stats.summary()
+
+
+def add_parser_args(parser):
+    parser.add_argument('--input', '-i', required=True, type=str,
+                        help='Directory of FITS images, or glob pattern like "Light/aLight*.fits"')
+    parser.add_argument('--registration', '-r', required=True, type=str,
+                        help="Path to registration file created by led_selector")
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help='Number of processes to use, defaults to number of cpus')
+    parser.add_argument('--summary', type=str, required=False, default=None,
+                        help='Also save the summary to this file')
+    parser.add_argument('--store', type=str, required=False, default=None,
+                        help='Add time data of each image to this result store file, created if needed')
+    parser.add_argument('--no-json', action='store_true',
+                        help="Don't save an .ettime file for each image, use with --store")
+    parser.add_argument('--band-only', action='store_true',
+                        help='Only read and stretch the rows of the image with LEDs, faster on large images. The stretch '
+                             'is from those rows only, so times can differ a little from reading the whole image')
+    parser.add_argument('--raw', action='store_true',
+                        help='Read time from the image data as is without stretching, only reads rows with LEDs')
+    parser.add_argument('--track', action='store_true',
+                        help='Follow small movement of the LED band since registration, needs a registration file with a reference')
+    parser.add_argument('--verbose', '-v', action='count', default=0,
+                        help='How much debug info, -v to print errors')
+
+
+def main(args):
+    if args.no_json and args.store is None:
+        raise Exception('Need --store when using --no-json')
+    fits_files = find_fits_files(args.input)
+    if len(fits_files) == 0:
+        raise Exception('No FITS files found: ' + args.input)
+    summary = run_batch(args.registration, fits_files, args.workers, args.band_only, args.raw, args.verbose,
+                        store_path=args.store, write_json=not args.no_json, track=args.track)
+    print(json.dumps(summary, indent=4))
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=4)
+
+
+def main_cli():
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='Batch Read Time',
+        description='Read time info from many images')
+    add_parser_args(parser)
+    args = parser.parse_args()
+    main(args)
+
+
+if __name__ == '__main__':
+    main_cli()
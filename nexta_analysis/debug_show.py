@@ -1,11 +1,10 @@
-import queue
 import time
 import tkinter
-import traceback
 
 import cv2
 import numpy as np
 
+import tk_queue
 from NACanvas import NACanvas
 
 windows = {}
@@ -13,36 +12,6 @@ gui_queue = None
 root = None
 
 
-def process_gui_queue():
-    global gui_queue, root
-    is_quit = False
-    try:
-        command = gui_queue.get(0)
-        if command[0] == 'quit':
-            is_quit = True
-        else:
-            args = []
-            kwargs = {}
-            method = command[0]
-            if len(command) > 1:
-                args = command[1]
-            if len(command) > 2:
-                kwargs = command[2]
-            if args is not None:
-                # print(args, kwargs)
-                method(*args, **kwargs)
-            else:
-                method()
-    except queue.Empty:
-        pass
-    except Exception as e:
-        traceback.print_exc()
-    finally:
-        if not is_quit:
-            if root:
-                root.after(50, process_gui_queue)
-
-
 def on_exit(name):
     global windows, root, gui_queue
     if name in windows:
@@ -111,9 +80,8 @@ def show(name, image):
         root = tkinter.Tk()
         # root.overrideredirect(1)
         root.withdraw()
-        gui_queue = queue.Queue()
+        gui_queue = tk_queue.TkQueue(root)
         windows[name] = ImageWindow(root, name, image, True)
-        root.after(250, process_gui_queue)
     else:
         if name in windows:
             w = windows[name]
@@ -0,0 +1,177 @@
+# Exposure Timing - NEXTA Analysis
+# Copyright (C) 2024 Russell Valentine
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Jobs that can run at once, a new image can load while the last one is still being read
+JOB_WORKERS = 2
+
+
+class JobCancelled(Exception):
+    """
+    Raised at a progress checkpoint of a job that was cancelled.
+    """
+    pass
+
+
+class Job:
+    """
+    Work running in a JobManager. The work method is given the job's progress method, which reports how far along it is
+    and is where the work stops if the job was cancelled.
+    """
+
+    def __init__(self, job_id, name, tag, progresscb, run_in_gui):
+        """
+        :param job_id: Unique id of the job
+        :param name: What the job does, like 'readtime'
+        :param tag: What the job's result is for, like which image, results are dropped if it is no longer current
+        :param progresscb: Called in the GUI with the job, message, done and total on each progress checkpoint
+        :param run_in_gui: Method to run a callback in the GUI thread
+        """
+        self.id = job_id
+        self.name = name
+        self.tag = tag
+        self.__cancelled = threading.Event()
+        self.__progresscb = progresscb
+        self.__run_in_gui = run_in_gui
+
+    def cancel(self):
+        """
+        Asks the job to stop at its next progress checkpoint. A job that hasn't started yet stops before it runs.
+        """
+        self.__cancelled.set()
+
+    def is_cancelled(self):
+        return self.__cancelled.is_set()
+
+    def check(self):
+        """
+        :raises JobCancelled: if the job was cancelled
+        """
+        if self.__cancelled.is_set():
+            raise JobCancelled('Job cancelled: ' + str(self.id) + ' ' + self.name)
+
+    def progress(self, message, done=None, total=None):
+        """
+        Progress checkpoint, passed to work methods as their progress argument. Can be called from any thread.
+        :param message: What the job is doing
+        :param done: How much is done, like rows read
+        :param total: How much there is to do
+        :raises JobCancelled: if the job was cancelled
+        """
+        self.check()
+        if self.__progresscb is not None:
+            self.__run_in_gui(self.__progresscb, self, message, done, total)
+
+
+class JobManager:
+    """
+    Runs work methods on a thread pool, with callbacks in the GUI thread when they are done.
+    """
+
+    def __init__(self, run_in_gui, workers=JOB_WORKERS):
+        """
+        :param run_in_gui: Method to run a callback in the GUI thread, with args after it
+        :param workers: Jobs that can run at once
+        """
+        self.__run_in_gui = run_in_gui
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+        self.__jobs = {}
+
+    def submit(self, name, work_method, successcb, errorcb, *args, tag=None, progresscb=None, donecb=None,
+               is_current=None, **kwargs):
+        """
+        Runs work_method(*args, progress=job.progress, **kwargs) in the pool.
+        :param name: What the job does
+        :param work_method: Method to run, takes a progress keyword argument
+        :param successcb: Called in the GUI with the tuple work_method returns as args
+        :param errorcb: Called in the GUI with the exception if work_method raises, not if the job was cancelled
+        :param tag: What the job's result is for
+        :param progresscb: Called in the GUI with job, message, done and total on each progress checkpoint
+        :param donecb: Called in the GUI with the job when it is done, even if it was cancelled or its result dropped
+        :param is_current: Called in the GUI with the tag before successcb or errorcb, the result is dropped if it
+                           returns False
+        :return: The job
+        :rtype: Job
+        """
+        job = Job(next(self.__ids), name, tag, progresscb, self.__run_in_gui)
+        with self.__lock:
+            self.__jobs[job.id] = job
+        self.__executor.submit(self.__run, job, work_method, successcb, errorcb, donecb, is_current, args,
+                               kwargs)
+        return job
+
+    def __run(self, job, work_method, successcb, errorcb, donecb, is_current, args, kwargs):
+        try:
+            job.check()
+            ret = work_method(*args, progress=job.progress, **kwargs)
+            self.__run_in_gui(self.__done, job, successcb, ret, donecb, is_current)
+        except JobCancelled:
+            self.__run_in_gui(self.__done, job, None, None, donecb, is_current)
+        except Exception as e:
+            if errorcb is None:
+                traceback.print_exc()
+            self.__run_in_gui(self.__done, job, errorcb, (e,), donecb, is_current)
+
+    def __done(self, job, cb, args, donecb, is_current):
+        """
+        In the GUI thread, calls the job's callback unless it was cancelled or its result is stale.
+        """
+        with self.__lock:
+            self.__jobs.pop(job.id, None)
+        if donecb is not None:
+            donecb(job)
+        if cb is None or job.is_cancelled():
+            return
+        if is_current is not None and not is_current(job.tag):
+            return
+        if args is not None:
+            cb(*args)
+        else:
+            cb()
+
+    def get_jobs(self):
+        """
+        :return: Jobs that haven't finished, oldest first
+        :rtype: List[Job]
+        """
+        with self.__lock:
+            return list(self.__jobs.values())
+
+    def cancel(self, name=None, tag=None):
+        """
+        Cancels running jobs.
+        :param name: Only jobs with this name, any name if None
+        :param tag: Only jobs with this tag, any tag if None
+        :return: Jobs cancelled
+        :rtype: List[Job]
+        """
+        jobs = [job for job in self.get_jobs() if (name is None or job.name == name) and (tag is None or job.tag == tag)]
+        for job in jobs:
+            job.cancel()
+        return jobs
+
+    def shutdown(self):
+        """
+        Cancels all jobs, doesn't wait for running ones to reach a checkpoint.
+        """
+        self.cancel()
+        self.__executor.shutdown(wait=False, cancel_futures=True)
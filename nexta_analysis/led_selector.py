@@ -15,13 +15,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import json
 import math
 import traceback
 
 import cv2
 import numpy as np
-from auto_stretch.stretch import Stretch
 
 import aruco_detect
 import debug_show
@@ -48,13 +46,24 @@ BOARDS = {
     '[0, 1, 3, 4]': {
         'version': 'v2.x.x',
         'distances': {'0-1': 61.680},
+        # Marker centers in board mm, from hardware/pcb/nexta.kicad_pcb
+        'markers': {0: [108.24, 101.98], 1: [169.92, 101.98], 3: [120.14, 89.4], 4: [158.02, 89.4]},
+        'marker_size': 7.005,  # Outer corner to corner, mm
         'leds': {
+            'size': 10,
             'ledsize': [1.78, 5.08],
+            'pitch': 2.54,
+            # Center of the first LED of each bar graph, the one nearest marker 0, board mm
+            'groups': [[114.48, 101.77], [140.90, 101.77]],
             '0-1': 4.0,  # 4.952
             'v': 5.30  # 5.39
         }
     }
 }
+# Ways to find the LEDs of a registration image
+METHODS = ('contours', 'geometry')
+# Blob area compared to LED area for local refinement to move an LED polygon
+REFINE_AREA_RANGE = (0.5, 1.5)
 
 
 def shrink_line_remove_mark(line, px_per_mm, marker_mm):
@@ -114,12 +123,11 @@ def get_aruco_points(img, dscale, verbose=0):
     :return:
     """
     # Aruco Detect expects black markers, but we put white ones in the board so we invert.
-    iimg = 255 - np.uint8(img)
-    # Dust, hair, slight shadows can cause an issue, so we blur to try to work around that.
-    iimg = cv2.GaussianBlur(iimg, (15, 15), 0)
-    arucos, ids, debug_info = aruco_detect.detect(iimg)
+    # Dust, hair, slight shadows can cause an issue, so it is blurred to try to work around that. Both are only done on
+    # the downsampled image markers are found in.
+    arucos, ids, debug_info = aruco_detect.detect_pyramid(np.asarray(img, dtype=np.uint8), invert=True, blur=15)
     if verbose >= 2:
-        debug_img = cv2.cvtColor(np.float32(iimg), cv2.COLOR_GRAY2BGR)
+        debug_img = cv2.cvtColor(np.float32(255 - np.uint8(img)), cv2.COLOR_GRAY2BGR)
         for k in arucos.keys():
             mark = arucos[k]
             cv2.circle(debug_img, np.int32(np.array(mark['center'])), int(5 / dscale), (0, 0, 255), -1)
@@ -149,7 +157,6 @@ def get_led_roi(arucos, ids, img, dscale, verbose=0):
     roi_line = shrink_line_remove_mark(roi_line, roi_px_per_mm, BOARDS[str(ids)]['leds']['0-1'])
     roi_height = BOARDS[str(ids)]['leds']['v'] * roi_px_per_mm
     rect = expand_rect_from_line(roi_line, roi_height * 2)
-    roi_mask = read_time.get_poly_mask(img, rect)
 
     if verbose >= 1:
         print(rect)
@@ -159,26 +166,42 @@ def get_led_roi(arucos, ids, img, dscale, verbose=0):
         debug_show.show('debug', debug_img)
         debug_show.wait(10000)
 
-    return roi_mask, roi_line, roi_px_per_mm, rect
+    return roi_line, roi_px_per_mm, rect
 
 
-def get_roi_image(img, roi_rect, roi_mask, verbose=0):
+def get_roi_crop(img, roi_rect):
+    """
+    Crops the image to the ROI rectangle, so the rest of registration only works on the area around the LED bars.
+    :param img: Full image
+    :param roi_rect: ROI rectangle points in the full image
+    :return: View of the image around the ROI, ROI rectangle in crop coordinates, offset of the crop in the image
+    """
+    rect = np.array(roi_rect, dtype=np.int32)
+    # One pixel margin so LED contours don't touch the crop edge
+    x1, y1 = np.maximum(rect.min(axis=0) - 1, 0)
+    x2, y2 = np.minimum(rect.max(axis=0) + 2, [img.shape[1], img.shape[0]])
+    if x2 <= x1 or y2 <= y1:
+        raise Exception('LED ROI is outside of the image: ' + str(rect.tolist()))
+    offset = np.array([x1, y1], dtype=np.int32)
+    return img[y1:y2, x1:x2], rect - offset, offset
+
+
+def get_roi_image(img, roi_rect, verbose=0):
     """
     Gives image with only LED bars non-zero
-    :param img:
-    :param roi_rect:
-    :param roi_mask:
+    :param img: Image cropped with get_roi_crop
+    :param roi_rect: ROI rectangle in crop coordinates
     :param verbose:
     :return:
     """
+    roi_mask = read_time.get_poly_mask(img, roi_rect)
     # ROI Stats
-    led_roi_values = read_time.get_poly_values(img, roi_rect)
+    led_roi_values = img[roi_mask]
     led_roi_mean = led_roi_values.mean()
     led_roi_std = led_roi_values.std()
 
-    img_led = img.copy()
     # roi_image is only led bargraph coponent, everything else is black
-    roi_image = cv2.bitwise_and(img_led, img_led, mask=np.uint8(roi_mask) * 255)
+    roi_image = cv2.bitwise_and(img, img, mask=np.uint8(roi_mask) * 255)
     if verbose >= 1:
         print('stat:', led_roi_mean, led_roi_std)
     return roi_image, led_roi_mean
@@ -189,7 +212,7 @@ def get_contours(roi_image, roi_mean, img, dscale, verbose=0):
     Find LED contours from a image with LED bars having value.
     :param roi_image: Image with just the LED bars as non-zero
     :param roi_mean: Mean of the LED bar area
-    :param img: Original area
+    :param img: Original area, cropped the same as roi_image
     :param dscale: debug scaling value
     :param verbose: how much debug output
     :return: LED contours
@@ -210,23 +233,34 @@ def get_contours(roi_image, roi_mean, img, dscale, verbose=0):
     return contours
 
 
-def find_ordered_LED_polypoints(img, dscale, verbose=0):
+def find_ordered_LED_polypoints(img, dscale, verbose=0, progress=None):
     """
     Automated method to try to find LED polygons.
     :param img:
     :param dscale:
     :param verbose:
+    :param progress: Called with a message between steps, raise from it to stop, like jobs.Job.progress
     :return:
     """
-    debug_img = cv2.cvtColor(np.float32(img), cv2.COLOR_GRAY2BGR)
-
     # First find Aruco points
+    if progress is not None:
+        progress('Finding markers')
     arucos, ids = get_aruco_points(img, dscale, verbose)
 
-    roi_mask, roi_line, roi_px_per_mm, roi_rect = get_led_roi(arucos, ids, img, dscale, verbose)
+    roi_line, roi_px_per_mm, roi_rect = get_led_roi(arucos, ids, img, dscale, verbose)
+
+    # Everything from here on is in the coordinates of the crop around the ROI, moved back to the image at the end.
+    crop, crop_rect, offset = get_roi_crop(img, roi_rect)
+    roi_line = roi_line - offset
+    if verbose >= 2:
+        debug_img = cv2.cvtColor(np.float32(crop), cv2.COLOR_GRAY2BGR)
 
-    roi_image, roi_mean = get_roi_image(img, roi_rect, roi_mask, verbose)
-    contours = get_contours(roi_image, roi_mean, img, dscale, verbose)
+    if progress is not None:
+        progress('Finding LED contours')
+    roi_image, roi_mean = get_roi_image(crop, crop_rect, verbose)
+    contours = get_contours(roi_image, roi_mean, crop, dscale, verbose)
+    if progress is not None:
+        progress('Ordering LEDs')
 
     # Filter contours to find our LEDs
     # Only care about the contours that are LEDs
@@ -274,6 +308,7 @@ def find_ordered_LED_polypoints(img, dscale, verbose=0):
         for p in poly:
             points.append(p[0].tolist())
         ourled['points'] = points
+        ourled['image_points'] = (poly.reshape(-1, 2) + offset).tolist()
         if verbose >= 2:
             cv2.circle(debug_img, np.int32(ourled['centroid']), int(5 / dscale), (255, 0, 255), -1)
             cv2.polylines(debug_img, [poly.reshape((-1, 1, 2))], True, (255, 0, 255), int(2 / dscale + 0.5))
@@ -291,7 +326,123 @@ def find_ordered_LED_polypoints(img, dscale, verbose=0):
         debug_show.show('debug', debug_img)
         debug_show.wait(10000)
     # Make our array of ordered poly points.
-    ret = [ourled['points'] for ourled in ourleds]
+    ret = [ourled['image_points'] for ourled in ourleds]
+    return ret
+
+
+def get_board_homography(arucos, board):
+    """
+    Homography from board mm to image pixels. Starts from the marker centers, then uses all marker corners matched to
+    where the center homography expects them.
+    :param arucos: Detected markers from get_aruco_points
+    :param board: Entry of BOARDS with marker positions
+    :return: 3x3 homography
+    """
+    ids = sorted(board['markers'].keys())
+    board_centers = np.float32([board['markers'][i] for i in ids])
+    image_centers = np.float32([arucos[i]['center'] for i in ids])
+    homography = cv2.findHomography(board_centers, image_centers, 0)[0]
+    if homography is None:
+        raise Exception('Unable to find homography from marker centers')
+    half = board['marker_size'] / 2
+    offsets = np.float32([[-half, -half], [half, -half], [half, half], [-half, half]])
+    board_points = []
+    image_points = []
+    for i, center in zip(ids, board_centers):
+        expected_board = center + offsets
+        expected = cv2.perspectiveTransform(expected_board.reshape(-1, 1, 2), homography).reshape(-1, 2)
+        corners = np.float32(arucos[i]['corners'])
+        # Marker orientation on the board doesn't matter, match each expected corner to the nearest detected one
+        distances = np.linalg.norm(expected[:, np.newaxis] - corners[np.newaxis], axis=2)
+        nearest = distances.argmin(axis=1)
+        if len(set(nearest.tolist())) != 4 or distances.min(axis=1).max() > np.linalg.norm(corners[0] - corners[2]) / 4:
+            # Corners don't look like the board, the center homography is the best we have
+            return homography
+        board_points.extend(expected_board)
+        image_points.extend(corners[nearest])
+    board_points = np.float32(board_points + list(board_centers))
+    image_points = np.float32(image_points + list(image_centers))
+    refined = cv2.findHomography(board_points, image_points, 0)[0]
+    return homography if refined is None else refined
+
+
+def get_board_led_polys(board, homography):
+    """
+    :param board: Entry of BOARDS with LED positions
+    :param homography: From get_board_homography
+    :return: 20x4x2 float array of LED rectangles in the image, in registration order, nearest marker 0 first
+    """
+    leds = board['leds']
+    direction = np.float64(board['markers'][1]) - np.float64(board['markers'][0])
+    along = direction / np.linalg.norm(direction)
+    across = np.array([-along[1], along[0]])
+    half_along = along * leds['ledsize'][0] / 2
+    half_across = across * leds['ledsize'][1] / 2
+    rects = []
+    for first in leds['groups']:
+        for i in range(leds['size']):
+            center = np.float64(first) + along * leds['pitch'] * i
+            rects.append([center - half_along - half_across, center + half_along - half_across,
+                          center + half_along + half_across, center - half_along + half_across])
+    rects = np.float32(rects)
+    return cv2.perspectiveTransform(rects.reshape(-1, 1, 2), homography).reshape(-1, 4, 2)
+
+
+def refine_led_poly(img, poly):
+    """
+    Moves an LED polygon onto the lit LED blob around it, if there is one with about the LED's area.
+    :param img: Stretched registration image
+    :param poly: 4x2 LED rectangle in the image
+    :return: The moved polygon, or the same polygon if no LED blob was found
+    """
+    center = poly.mean(axis=0)
+    extent = np.abs(poly - center).max(axis=0) * 2
+    x1, y1 = np.int32(np.maximum(center - extent, 0))
+    x2, y2 = np.int32(np.minimum(center + extent + 1, [img.shape[1], img.shape[0]]))
+    window = np.uint8(img[y1:y2, x1:x2])
+    if window.size == 0 or window.max() == window.min():
+        return poly
+    thresh = cv2.threshold(window, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh)
+    if count < 2:
+        return poly
+    # Blob nearest where the LED should be
+    local_center = center - [x1, y1]
+    nearest = 1 + np.linalg.norm(centroids[1:] - local_center, axis=1).argmin()
+    area = cv2.contourArea(np.float32(poly))
+    if not REFINE_AREA_RANGE[0] * area < stats[nearest, cv2.CC_STAT_AREA] < REFINE_AREA_RANGE[1] * area:
+        return poly
+    shift = centroids[nearest] - local_center
+    # A blob farther than half the LED's width away is a neighbor
+    if np.linalg.norm(shift) > np.linalg.norm(poly[1] - poly[0]) / 2:
+        return poly
+    return poly + shift
+
+
+def find_geometry_LED_polypoints(img, dscale, verbose=0, refine=False):
+    """
+    Finds LED polygons by projecting the board's LED positions into the image with a homography from the aruco
+    markers. Doesn't need the LEDs to be separable by thresholding, only the board to have LED positions in BOARDS.
+    :param img: Stretched registration image
+    :param dscale: debug scaling value
+    :param verbose: how much debug output
+    :param refine: Move each LED polygon onto the lit LED near it
+    :return: Ordered LED polygon points, same as find_ordered_LED_polypoints
+    """
+    arucos, ids = get_aruco_points(img, dscale, verbose)
+    board = BOARDS[str(ids)]
+    if 'groups' not in board['leds']:
+        raise Exception('No LED positions for board ' + board['version'] + ', use contours method')
+    homography = get_board_homography(arucos, board)
+    if verbose >= 1:
+        print('homography:', homography)
+    polys = get_board_led_polys(board, homography)
+    if refine:
+        polys = [refine_led_poly(img, poly) for poly in polys]
+    ret = [np.int32(np.round(poly)).tolist() for poly in polys]
+    if verbose >= 2:
+        debug_show.show('debug', draw_ordered_led_polys(img, ret, dscale))
+        debug_show.wait(10000)
     return ret
 
 
@@ -327,6 +478,10 @@ def add_parser_args(parser):
     parser.add_argument('--output', '-o', required=True, type=str, help='Output of Registration data')
     parser.add_argument('--scale', '-s', type=float, required=False, default=-1,
                         help='How much to scale manual area selection image or debug images, defaults to an calculated reasonable value to fit on screen')
+    parser.add_argument('--method', type=str, choices=METHODS, default='contours',
+                        help='Find LEDs by their contours, or by projecting LED positions of the board from the markers')
+    parser.add_argument('--refine', action='store_true',
+                        help='With geometry method, move each LED area onto the lit LED near it')
     parser.add_argument('--verbose', '-v', action='count', default=0,
                         help='How much debug info, -v for text, -vv for graphical debug info')
 
@@ -345,14 +500,17 @@ def main(args):
     imgname = args.reference_image
     # img = cv2.imread(sys.argv[1])
     img = read_time.open_fits(imgname)[0]
-    stretched_img = np.uint8(Stretch().stretch(img) * 255)
+    stretched_img = read_time.stretch_image(img)
     if args.scale > 0:
         scale = args.scale
     else:
         scale = 1000 / max(img.shape)
     led_poly_points = []
     try:
-        led_poly_points = find_ordered_LED_polypoints(stretched_img, scale, args.verbose)
+        if args.method == 'geometry':
+            led_poly_points = find_geometry_LED_polypoints(stretched_img, scale, args.verbose, args.refine)
+        else:
+            led_poly_points = find_ordered_LED_polypoints(stretched_img, scale, args.verbose)
     except Exception as e:
         if args.verbose >= 1:
             traceback.print_exception(e)
@@ -360,8 +518,8 @@ def main(args):
         print('Number of polys:', len(led_poly_points))
     if len(led_poly_points) != 20:
         raise (Exception('Not able to auto detect LED bar graph, using GUI to manually make registration file.'))
-    with open(args.output, 'w') as f:
-        json.dump(led_poly_points, f)
+    # Keep a crop of the LED band so read time can track movement of the board
+    read_time.Registration.from_image(led_poly_points, stretched_img).save(args.output)
     # Lets show the final result.
     pimg = draw_ordered_led_polys(stretched_img, led_poly_points, scale)
     debug_show.show('complete', pimg)
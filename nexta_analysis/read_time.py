@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
 import json
 import math
 
@@ -22,11 +23,28 @@ import cv2
 import numpy as np
 from astropy.io import fits
 from auto_stretch.stretch import Stretch
-from typing import Dict
 
 import debug_show
 
 
+# Extra rows read above and below the LED band.
+BAND_MARGIN = 16
+# Number of pixels used to estimate the stretch parameters of integer images.
+STRETCH_SAMPLE_SIZE = 1 << 20
+# Rows of the LED band summed at a time, bounds the memory of the cumulative sums.
+ROW_CHUNK_SIZE = 256
+# Columns of board kept on either side of the LEDs in the registration reference crop.
+TRACK_MARGIN = 32
+# Largest LED band shift in pixels that tracking corrects, band images only have BAND_MARGIN extra rows.
+TRACK_MAX_SHIFT = BAND_MARGIN
+# Fraction of lit columns that have to fall on LED columns for a column shift to count as a match.
+TRACK_MIN_RESPONSE = 0.75
+# Lit pixels inside the moved LED polygons can be at most this fraction less than in the reference.
+TRACK_COVERAGE_TOLERANCE = 0.1
+# Rows the LED band height can differ from the reference before it is not trusted for tracking.
+TRACK_HEIGHT_TOLERANCE = 3
+
+
 def open_fits(fits_filename):
     """
     Returns mono image data or green channel if bayer or multi channel fits. Also DATE-OBS, EXPTIME values
@@ -40,39 +58,142 @@ def open_fits(fits_filename):
         # Use green channel
         img = img[1]
     elif 'BAYERPAT' in fitsimg[0].header:
-        # Just use G channel
-        pattern = fitsimg[0].header['BAYERPAT'].strip()
-        xoffset = fitsimg[0].header.get('XBAYROFF', 0)
-        yoffset = fitsimg[0].header.get('YBAYOFF', 0)
-        if pattern == 'RGGB':
-            img = cv2.cvtColor(img, cv2.COLOR_BayerBG2RGB)[:, :, 1]
-        elif pattern == 'GRBG':
-            img = cv2.cvtColor(img, cv2.COLOR_BayerGB2RGB)[:, :, 1]
-        elif pattern == 'BGGR':
-            img = cv2.cvtColor(img, cv2.COLOR_BayerRG2RGB)[:, :, 1]
-        elif pattern == 'GBRG':
-            img = cv2.cvtColor(img, cv2.COLOR_BayerGR2RGB)[:, :, 1]
+        img = get_bayer_green(img, fitsimg[0].header)
 
     return img, fitsimg[0].header['DATE-OBS'], fitsimg[0].header['EXPTIME']
 
 
-def get_poly_values(fitsimg, poly):
+def open_fits_band(fits_filename, y_min, y_max, margin=BAND_MARGIN):
     """
-    Get the values from an image inside a polygon
-    :param fitsimg:
-    :param poly:
-    :return:
+    Like open_fits, but memory maps the fits file and only reads the rows y_min to y_max (plus margin).
+    :param fits_filename: Path or file object of fits image.
+    :param y_min: First row we need
+    :param y_max: Row after the last we need
+    :param margin: Extra rows to read on either side
+    :return: single channel img of the band, y_offset of the first row of the band, rows in the full image,
+             header values DATE-OBS, EXPTIME, BAYERPAT
+    :rtype: np.ndarray, int, int, Dict
     """
-    # https://stackoverflow.com/questions/60964249/how-to-check-the-color-of-pixels-inside-a-polygon-and-remove-the-polygon-if-it-c
-    # https://stackoverflow.com/questions/30901019/extracting-polygon-given-coordinates-from-an-image-using-opencv
-    # rayryeng
-    mask = get_poly_mask(fitsimg, poly)
-    out = np.zeros_like(fitsimg)
-    out[mask] = fitsimg[mask]
-    # print(fitsimg[mask])
-    # debug_show.show('Test', cv2.threshold(out, 1, 1, cv2.THRESH_BINARY)[1])
-    # debug_show.wait(0)
-    return fitsimg[mask]
+    # Scaled data (BZERO for unsigned ints) can't be memory mapped, so we scale just the band ourselves.
+    with fits.open(fits_filename, memmap=True, do_not_scale_image_data=True) as fitsimg:
+        hdu = fitsimg[0]
+        header = hdu.header
+        shape = hdu.shape
+        rows = shape[-2]
+        if y_min < 0 or y_max > rows:
+            raise Exception('Image does not have the rows of the registration')
+        y0 = max(y_min - margin, 0)
+        y1 = min(y_max + margin, rows)
+        is_rgb = len(shape) == 3 and shape[0] == 3
+        if not is_rgb and 'BAYERPAT' in header:
+            # Keep bayer pattern lined up
+            y0 -= y0 % 2
+        if is_rgb:
+            img = hdu.section[1, y0:y1]
+        else:
+            img = hdu.section[y0:y1]
+        img = scale_fits_data(img, header.get('BSCALE', 1), header.get('BZERO', 0))
+        if not is_rgb and 'BAYERPAT' in header:
+            img = get_bayer_green(img, header)
+        header_values = {'DATE-OBS': header['DATE-OBS'], 'EXPTIME': header['EXPTIME'],
+                         'BAYERPAT': header.get('BAYERPAT')}
+    return img, y0, rows, header_values
+
+
+def scale_fits_data(data, bscale, bzero):
+    """
+    Applies BSCALE and BZERO to raw fits data, like astropy does when it loads data.
+    :param data: raw fits data
+    :param bscale:
+    :param bzero:
+    :return: scaled data, in native byte order
+    """
+    data = data.astype(data.dtype.newbyteorder('='), copy=False)
+    if bscale == 1 and bzero == 0:
+        return data
+    if bscale == 1 and data.dtype.kind == 'i' and bzero == 2 ** (8 * data.dtype.itemsize - 1):
+        # Unsigned ints are stored as signed with BZERO offset
+        return (data.astype(np.int64) + bzero).astype('u' + str(data.dtype.itemsize))
+    return data * np.float32(bscale) + np.float32(bzero)
+
+
+# Bayer patterns, and if green is where row + column is even (0) or odd (1)
+BAYER_GREEN_PARITY = {'RGGB': 1, 'BGGR': 1, 'GRBG': 0, 'GBRG': 0}
+
+
+def get_bayer_green(img, header):
+    """
+    Green channel of a bayer image, without demosaicing the other colors. Green pixels are kept, the red and
+    blue pixels get the value of the green pixel next to them on the same row.
+    :param img: bayer image
+    :param header: fits header with BAYERPAT, and optionally XBAYROFF, YBAYOFF
+    :return: green channel, same size and type as img
+    """
+    pattern = header['BAYERPAT'].strip()
+    if pattern not in BAYER_GREEN_PARITY:
+        return img
+    xoffset = int(header.get('XBAYROFF', 0))
+    yoffset = int(header.get('YBAYOFF', 0))
+    green_parity = (BAYER_GREEN_PARITY[pattern] + xoffset + yoffset) % 2
+    cols = img.shape[1]
+    green = np.array(img)
+    for row_parity in (0, 1):
+        rows = slice(row_parity, None, 2)
+        if (green_parity - row_parity) % 2 == 0:
+            # Green in even columns, use green to the left
+            green[rows, 1::2] = img[rows, 0::2][:, :cols // 2]
+        else:
+            # Green in odd columns, use green to the right, or left for a last even column
+            green[rows, 0::2][:, :cols // 2] = img[rows, 1::2]
+            if cols % 2 == 1:
+                green[rows, cols - 1] = img[rows, cols - 2]
+    return green
+
+
+def stretch_image(img, target_bkg=0.25, shadows_clip=-1.25, sample_size=STRETCH_SAMPLE_SIZE):
+    """
+    Same stretch as auto_stretch's Stretch().stretch(), scaled to uint8. For 8 and 16 bit images the median and
+    average deviation are estimated from a subsample of pixels and the stretch is done with a lookup table, without
+    making float copies of the image. Other types use Stretch.
+    :param img: 2d image
+    :param target_bkg: Stretch target background
+    :param shadows_clip: Stretch shadows clipping, in average deviations from the median
+    :param sample_size: About how many pixels to use to estimate the median
+    :return: uint8 stretched image
+    """
+    if img.dtype not in (np.uint8, np.uint16):
+        return np.uint8(Stretch(target_bkg, shadows_clip).stretch(img) * 255)
+    max_val = int(img.max())
+    if max_val == 0:
+        return np.zeros(img.shape, dtype=np.uint8)
+    flat = img.reshape(-1)
+    sample = flat[::max(1, flat.size // sample_size)] / max_val
+    median = np.median(sample)
+    avg_dev = np.mean(np.abs(sample - median))
+    c0 = float(np.clip(median + shadows_clip * avg_dev, 0, 1))
+    if c0 >= 1:
+        return np.zeros(img.shape, dtype=np.uint8)
+    m = mtf(target_bkg, (median - c0) / (1 - c0))
+
+    levels = np.arange(np.iinfo(img.dtype).max + 1) / max_val
+    lut = np.where(levels < c0, 0, mtf(m, (levels - c0) / (1 - c0)))
+    lut = np.uint8(np.clip(lut, 0, 1) * 255)
+    if img.dtype == np.uint8:
+        return cv2.LUT(img, lut)
+    return lut[img]
+
+
+def mtf(m, x):
+    """
+    Midtones transfer function, 0 at 0, 0.5 at m and 1 at 1.
+    :param m: midtones balance
+    :param x: value or array of values between 0 and 1
+    :return: transformed values
+    """
+    x = np.asarray(x, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = (m - 1) * x / ((2 * m - 1) * x - m)
+    return np.where(x == 0, 0, np.where(x == 1, 1, y))
 
 
 def get_poly_mask(img, poly):
@@ -110,576 +231,1179 @@ def get_poly_rectangle(poly):
     return x1, y1, x2, y2, poly
 
 
-def decode_nexta_digit(digit):
-    """
-    Decodes a NEXTA digit (4 leds)
-    :param digit: 1 or on 0 for off
-    :return: Number decode, or if invalide then '?'
-    :rtype: int | str
-    """
-    if digit == '0000':
-        return 0
-    elif digit == '0001':
-        return 1
-    elif digit == '0010':
-        return 2
-    elif digit == '0100':
-        return 3
-    elif digit == '1000':
-        return 4
-    elif digit == '0011':
-        return 5
-    elif digit == '0110':
-        return 6
-    elif digit == '1100':
-        return 7
-    elif digit == '0111':
-        return 8
-    elif digit == '1111':
-        return 9
-    else:
-        return '?'
-
-
-def nexta_check_error(sled_values):
-    """
-    Checks if values are a known error code
-    :param sled_values:
-    :return: If error code and a error message that goes with it
-    :rtype: bool, str
-    """
-    if sled_values == '00000000000000000000':
-        return True, 'Powered off'
-    elif sled_values == '10100000000000000000':
-        return True, 'Internal clock drift too large'
-    elif sled_values == '10101000000000000000':
-        return True, 'GNSS signal lost'
-    elif sled_values == '10101010000000000000':
-        return True, 'Initial setup - waiting for GNSS fix'
-    elif sled_values == '10101010100000000000':
-        return True, 'Initial setup - measuring internal clock drift'
-    elif sled_values == '10101010101000000000':
-        return True, 'Initial setup - finished'
+def get_poly_row_spans(poly):
+    """
+    Turns a polygon into a table of per row spans, so a row scan only has to slice the image.
+    Uses the same area as get_poly_rectangle and get_poly_mask.
+    LEDs are rectangular, so we expect a single span per row.
+    :param poly: The polygon
+    :return: y1, y2, spans where spans[y - y1] is [x_start, x_end) in image coordinates, empty rows have x_start == x_end
+    :rtype: int, int, np.ndarray
+    """
+    px1, py1, px2, py2, ppoly = get_poly_rectangle(poly)
+    poly_mask = get_poly_mask(np.zeros((py2 - py1, px2 - px1), dtype=np.uint8), ppoly)
+    row_in = poly_mask.any(axis=1)
+    x_start = np.argmax(poly_mask, axis=1)
+    x_end = poly_mask.shape[1] - np.argmax(poly_mask[:, ::-1], axis=1)
+    spans = np.zeros((py2 - py1, 2), dtype=np.int32)
+    spans[row_in, 0] = px1 + x_start[row_in]
+    spans[row_in, 1] = px1 + x_end[row_in]
+    spans[~row_in] = px1
+    return py1, py2, spans
+
+
+def get_rois_row_spans(rois):
+    """
+    Span tables for all our LED polygons, see get_poly_row_spans
+    :param rois: Regions of interest (polygons of leds)
+    :return: List of y1, y2, spans for each roi
+    :rtype: List[Tuple[int, int, np.ndarray]]
+    """
+    return [get_poly_row_spans(roi) for roi in rois]
+
+
+def get_band_spans(y_min, y_max, roi_spans):
+    """
+    Span tables of all LEDs laid out by row of the LED band, so all rows can be looked up at once.
+    :param y_min: Lower bound of rows
+    :param y_max: Greater bound of rows
+    :param roi_spans: Span tables of our led polygons from get_rois_row_spans
+    :return: x_start, x_end (num_rows, num_leds), and in_row (num_rows, num_leds) if row is in the LED polygon
+             bounding rectangle
+    :rtype: np.ndarray, np.ndarray, np.ndarray
+    """
+    num_rows = y_max - y_min
+    num_leds = len(roi_spans)
+    x0 = np.zeros((num_rows, num_leds), dtype=np.intp)
+    x1 = np.zeros((num_rows, num_leds), dtype=np.intp)
+    in_row = np.zeros((num_rows, num_leds), dtype=np.bool_)
+    for led_idx, (py1, py2, spans) in enumerate(roi_spans):
+        lo = max(py1, y_min)
+        hi = min(py2, y_max)
+        if hi <= lo:
+            continue
+        x0[lo - y_min:hi - y_min, led_idx] = spans[lo - py1:hi - py1, 0]
+        x1[lo - y_min:hi - y_min, led_idx] = spans[lo - py1:hi - py1, 1]
+        in_row[lo - y_min:hi - y_min, led_idx] = True
+    return x0, x1, in_row
+
+
+class Registration:
+    """
+    Our 20 LED polygons, checked and compiled once so they can be used to read the time of many frames.
+    Can't be changed after it is made. Pickles as just the polygons and reference, and is compiled again when unpickled.
+    Optionally has a reference crop of the LED band from the registration image, used by track_registration.
+    """
+    LED_COUNT = 20
+    __slots__ = ('polygons', 'rects', 'masks', 'pixel_counts', 'row_spans', 'y_min', 'y_max', 'band_spans',
+                 'reference', 'reference_origin')
+
+    def __init__(self, polygons, reference=None, reference_origin=None):
+        """
+        :param polygons: List of 20 polygons, each a list of [x, y] points. In order, first seconds LED first.
+        :param reference: Optional uint8 crop of the LED band from the registration image
+        :param reference_origin: x, y of the reference crop's first pixel in the image
+        """
+        polygons = self.check_polygons(polygons)
+        if reference is not None:
+            reference = np.array(reference, dtype=np.uint8)
+            reference.flags.writeable = False
+            reference_origin = (int(reference_origin[0]), int(reference_origin[1]))
+        else:
+            reference_origin = None
+        rects = []
+        masks = []
+        for poly in polygons:
+            x1, y1, x2, y2, ppoly = get_poly_rectangle(poly)
+            # Same pixels as get_poly_mask on the full image, but only as big as the polygon.
+            mask = get_poly_mask(np.zeros((y2 - y1 + 1, x2 - x1 + 1), dtype=np.uint8), ppoly)
+            mask.flags.writeable = False
+            rects.append((x1, y1, x2, y2))
+            masks.append(mask)
+        row_spans = get_rois_row_spans(polygons)
+        ys = [y for rect in rects for y in (rect[1], rect[3])]
+        y_min = min(ys)
+        y_max = max(ys) + 1
+        band_spans = get_band_spans(y_min, y_max, row_spans)
+        for arr in [spans for py1, py2, spans in row_spans] + list(band_spans):
+            arr.flags.writeable = False
+
+        object.__setattr__(self, 'polygons', polygons)
+        object.__setattr__(self, 'rects', tuple(rects))
+        object.__setattr__(self, 'masks', tuple(masks))
+        object.__setattr__(self, 'pixel_counts', tuple(int(mask.sum()) for mask in masks))
+        object.__setattr__(self, 'row_spans', tuple(row_spans))
+        object.__setattr__(self, 'y_min', y_min)
+        object.__setattr__(self, 'y_max', y_max)
+        object.__setattr__(self, 'band_spans', band_spans)
+        object.__setattr__(self, 'reference', reference)
+        object.__setattr__(self, 'reference_origin', reference_origin)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Registration can not be changed')
+
+    def __delattr__(self, key):
+        raise AttributeError('Registration can not be changed')
+
+    def __reduce__(self):
+        return Registration, (self.to_json(), self.reference, self.reference_origin)
+
+    def __eq__(self, other):
+        return isinstance(other, Registration) and self.polygons == other.polygons
+
+    def __hash__(self):
+        return hash(self.polygons)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    @classmethod
+    def check_polygons(cls, polygons):
+        """
+        Makes sure polygons are something we can use.
+        :param polygons:
+        :return: polygons as tuple of tuples of (x, y)
+        :rtype: Tuple[Tuple[Tuple[int, int]]]
+        """
+        if not isinstance(polygons, (list, tuple)) or len(polygons) != cls.LED_COUNT:
+            raise Exception('Registration needs ' + str(cls.LED_COUNT) + ' LED polygons')
+        ret = []
+        for poly in polygons:
+            if not isinstance(poly, (list, tuple)) or len(poly) < 3:
+                raise Exception('LED polygon needs at least 3 points: ' + str(poly))
+            points = []
+            for point in poly:
+                if len(point) != 2:
+                    raise Exception('LED polygon point needs to be x, y: ' + str(point))
+                x, y = int(point[0]), int(point[1])
+                if x < 0 or y < 0:
+                    raise Exception('LED polygon point is outside of image: ' + str(point))
+                points.append((x, y))
+            ret.append(tuple(points))
+        return tuple(ret)
+
+    @classmethod
+    def from_image(cls, polygons, stretched_image):
+        """
+        Registration with a reference crop of the LED band, so later frames can be tracked against it.
+        :param polygons: List of 20 LED polygons
+        :param stretched_image: The stretched registration image the polygons are from
+        :rtype: Registration
+        """
+        polygons = cls.check_polygons(polygons)
+        xs = [x for poly in polygons for x, y in poly]
+        ys = [y for poly in polygons for x, y in poly]
+        x1 = max(min(xs) - TRACK_MARGIN, 0)
+        x2 = min(max(xs) + 1 + TRACK_MARGIN, stretched_image.shape[1])
+        # Same rows open_fits_band reads, so band images can be tracked
+        y1 = max(min(ys) - BAND_MARGIN, 0)
+        y2 = min(max(ys) + 1 + BAND_MARGIN, stretched_image.shape[0])
+        reference = np.uint8(np.clip(stretched_image[y1:y2, x1:x2], 0, 255))
+        return cls(polygons, reference, (x1, y1))
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        :param data: Contents of a .etreg file, a list of polygons, or a dict with polygons and a reference crop.
+        :rtype: Registration
+        """
+        if isinstance(data, dict):
+            reference = data.get('reference')
+            if reference is None:
+                return cls(data['polygons'])
+            png = np.frombuffer(base64.b64decode(reference['png']), dtype=np.uint8)
+            return cls(data['polygons'], cv2.imdecode(png, cv2.IMREAD_GRAYSCALE), reference['origin'])
+        return cls(data)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: Path or file object of a .etreg registration file.
+        :rtype: Registration
+        """
+        if hasattr(path, 'read'):
+            return cls.from_json(json.load(path))
+        with open(path) as f:
+            return cls.from_json(json.load(f))
+
+    def save(self, path):
+        """
+        :param path: Path or file object to write .etreg registration file.
+        """
+        data = self.to_json()
+        if self.reference is not None:
+            # Without a reference it is saved as just the polygons, like older .etreg files
+            png = cv2.imencode('.png', self.reference)[1]
+            data = {'polygons': data, 'reference': {'origin': list(self.reference_origin),
+                                                    'png': base64.b64encode(png.tobytes()).decode('ascii')}}
+        if hasattr(path, 'write'):
+            json.dump(data, path)
+        else:
+            with open(path, 'w') as f:
+                json.dump(data, f)
+
+    def to_json(self):
+        """
+        :return: Polygons as lists like the .etreg file has them.
+        :rtype: List[List[List[int]]]
+        """
+        return [[list(point) for point in poly] for poly in self.polygons]
+
+    def get_values(self, img, led_idx, y_offset=0):
+        """
+        img[get_poly_mask(img, polygons[led_idx])], only looks at the polygon's rectangle.
+        :param img:
+        :param led_idx:
+        :param y_offset: Row of the full image that is img's first row
+        :return: values
+        """
+        x1, y1, x2, y2 = self.rects[led_idx]
+        crop = img[y1 - y_offset:y2 + 1 - y_offset, x1:x2 + 1]
+        return crop[self.masks[led_idx][:crop.shape[0], :crop.shape[1]]]
+
+    def moved(self, shift, rotation=0.0):
+        """
+        :param shift: dx, dy to move the LED polygons by
+        :param rotation: Radians to rotate the polygons by around the center of the reference crop
+        :return: Registration with the polygons and reference crop origin moved, rounded to whole pixels. LED pixels
+                 are whole pixels, so a polygon moved less than half a pixel reads the same pixels.
+        :rtype: Registration
+        """
+        x0, y0 = self.reference_origin if self.reference is not None else (0, 0)
+        if self.reference is not None:
+            center = np.array([x0 + self.reference.shape[1] / 2, y0 + self.reference.shape[0] / 2])
+        else:
+            center = np.array([0.0, 0.0])
+        cos, sin = math.cos(rotation), math.sin(rotation)
+        rotate = np.array([[cos, -sin], [sin, cos]])
+        polygons = []
+        for poly in self.polygons:
+            points = (np.array(poly, dtype=np.float64) - center) @ rotate.T + center + shift
+            polygons.append(np.int32(np.round(points)).tolist())
+        origin = None
+        if self.reference is not None:
+            origin = (int(round(x0 + shift[0])), int(round(y0 + shift[1])))
+        return Registration(polygons, self.reference, origin)
+
+
+def get_lit_pixels(img):
+    """
+    :param img: Crop of the LED band, stretched or raw
+    :return: Mask of pixels brighter than Otsu's threshold, lit LEDs
+    """
+    values = np.float32(img)
+    lo, hi = np.percentile(values, [1, 99.9])
+    scaled = np.uint8(np.clip((values - lo) * (255 / max(hi - lo, 1e-6)), 0, 255))
+    thresh = cv2.threshold(scaled, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[0]
+    return scaled > thresh
+
+
+def get_led_mask(polygons, origin, shape):
+    """
+    :param polygons: LED polygons in image coordinates
+    :param origin: x, y of the crop in the image
+    :param shape: Shape of the crop
+    :return: Mask of the crop's pixels in the LED polygons
+    """
+    mask = np.zeros(shape, dtype=np.uint8)
+    points = [np.int32(np.round(np.array(poly, dtype=np.float64) - origin)) for poly in polygons]
+    cv2.fillPoly(mask, points, 1)
+    return mask > 0
+
+
+def match_led_columns(led_columns, profile, max_shift):
+    """
+    Finds the shift that puts the most lit columns on LED columns. Which LEDs are lit changes from frame to frame, so
+    lit columns are matched with where the LEDs are, not with what was lit in the reference. A lit band narrower than
+    the LED polygons matches over a range of shifts, the middle of it is used.
+    :param led_columns: 1 for columns of the crop with an LED polygon, 0 between them
+    :param profile: How lit each column of the crop is, 0 to 1
+    :param max_shift: Largest shift looked at, less than half the LED pitch so an LED can't match its neighbor
+    :return: How far profile is shifted from led_columns, and the fraction of the lit columns on LED columns
+    :rtype: float, float
+    """
+    total = profile.sum()
+    if total == 0:
+        return 0.0, 0.0
+    shifts = np.arange(-max_shift, max_shift + 1)
+    padded = np.pad(led_columns, max_shift)
+    n = len(profile)
+    # Column x of profile is on LED column x - shift
+    scores = np.array([(profile * padded[max_shift - shift:max_shift - shift + n]).sum() for shift in shifts]) / total
+    best = int(scores.argmax())
+    first = last = best
+    while first > 0 and scores[first - 1] >= scores[best] - 1e-9:
+        first -= 1
+    while last < len(scores) - 1 and scores[last + 1] >= scores[best] - 1e-9:
+        last += 1
+    return float(shifts[first] + shifts[last]) / 2, float(scores[best])
+
+
+def get_lit_coverage(lit, led_mask):
+    """
+    :return: Fraction of lit pixels that are in the LED polygons, None if nothing is lit
+    """
+    lit_count = lit.sum()
+    if lit_count == 0:
+        return None
+    # A pixel of slack for polygons rounded to whole pixels
+    led_mask = cv2.dilate(np.uint8(led_mask), np.ones((3, 3), np.uint8)) > 0
+    return float((lit & led_mask).sum() / lit_count)
+
+
+def get_lit_extent(lit, min_count):
+    """
+    :param lit: Lit pixels of part of the LED band
+    :param min_count: Lit pixels a row needs to be part of the band
+    :return: First and last row with a lit LED, None if there are none
+    """
+    rows = np.flatnonzero(lit.sum(axis=1) >= min_count)
+    if len(rows) == 0:
+        return None
+    return rows[0], rows[-1]
+
+
+def track_registration(registration, stretched_image, y_offset=0, max_shift=TRACK_MAX_SHIFT):
+    """
+    Finds how far the LED band moved since registration by comparing the same area of this image with the
+    registration's reference crop. Lit LEDs change from frame to frame and row to row, so only where there are lit LEDs
+    is compared. Columns are matched by moving the LED polygon columns onto the columns with lit LEDs, see
+    match_led_columns. Rows are matched by the first and last rows with lit LEDs, in the left and right half of the
+    band to also get a small rotation. The moved polygons have to hold about as much of the lit pixels as the
+    registration's polygons do in the reference, or the frame is flagged as drift instead of trusting the match.
+    Shifts are found to half a pixel, the middle of the matching columns and of the first and last lit rows, and the
+    moved polygons are rounded to whole pixels, see Registration.moved. Movement under half a pixel isn't corrected.
+    :param registration: Registration with a reference crop
+    :param stretched_image: Our image stretched, full image or a band of rows from open_fits_band
+    :param y_offset: Row of the full image that is stretched_image's first row
+    :param max_shift: Largest shift in pixels that is corrected
+    :return: Registration moved to match this image, or the registration as is if it couldn't be matched, and the
+             tracking info: shift [dx, dy], rotation in radians, response, the fraction of lit columns on LED
+             columns, coverage, the fraction of lit pixels in the moved LED polygons, and drift, True if the frame
+             moved too far or the LED band didn't match well enough to be corrected.
+    :rtype: Registration, Dict
+    """
+    if registration.reference is None:
+        raise Exception('Registration has no reference crop to track with, register again to make one')
+    reference = registration.reference
+    x0, y0 = registration.reference_origin
+    h, w = reference.shape
+    tracking = {'shift': None, 'rotation': None, 'response': None, 'coverage': None, 'drift': True}
+    if y0 < y_offset:
+        return registration, tracking
+    img = stretched_image[y0 - y_offset:y0 - y_offset + h, x0:x0 + w]
+    if img.shape != reference.shape:
+        return registration, tracking
+    reference_lit = get_lit_pixels(reference)
+    img_lit = get_lit_pixels(img)
+    # LEDs repeat every pitch, so a shift of around half of it or more can't be told apart from the other way
+    centers = sorted((x1 + x2) / 2 for x1, y1, x2, y2 in registration.rects)
+    max_dx = max(min(max_shift, int(0.4 * np.median(np.diff(centers)))), 1)
+    led_columns = np.float64(get_led_mask(registration.polygons, (x0, y0), reference.shape).any(axis=0))
+    # A couple of lit pixels in a column or half an LED's width in a row is enough to count as lit
+    dx, response = match_led_columns(led_columns, np.clip(img_lit.sum(axis=0) / 2, 0, 1), max_dx)
+    tracking['response'] = response
+    min_count = max(min(x2 - x1 for x1, y1, x2, y2 in registration.rects) // 2, 1)
+    half = w // 2
+    extents = []
+    for side in (slice(0, half), slice(w - half, w), slice(0, w)):
+        reference_extent = get_lit_extent(reference_lit[:, side], min_count)
+        img_extent = get_lit_extent(img_lit[:, side], min_count)
+        if reference_extent is not None and img_extent is not None:
+            extents.append((reference_extent, img_extent))
+        else:
+            extents.append(None)
+    if extents[0] is not None and extents[1] is not None:
+        sides = extents[0:2]
+    elif extents[2] is not None:
+        # All LEDs of one half are off, like at 0s, the whole band still gives the shift but not rotation
+        sides = extents[2:]
     else:
-        return False, ''
+        return registration, tracking
+    centers = [(img_extent[0] + img_extent[1] - reference_extent[0] - reference_extent[1]) / 2
+               for reference_extent, img_extent in sides]
+    heights = [(img_extent[1] - img_extent[0]) - (reference_extent[1] - reference_extent[0])
+               for reference_extent, img_extent in sides]
+    rotation = 0.0
+    if len(sides) == 2:
+        # Halves' centers are w - half apart
+        rotation = math.atan2(centers[1] - centers[0], w - half)
+    dy = sum(centers) / len(centers)
+    tracking['shift'] = [dx, dy]
+    tracking['rotation'] = rotation
+    # Rotation makes the band in each half taller, anything more means LEDs were off at the ends of the band
+    spread = half * abs(math.tan(rotation))
+    if abs(dx) >= max_dx or abs(dy) >= max_shift or response < TRACK_MIN_RESPONSE or \
+            max(abs(height) for height in heights) > TRACK_HEIGHT_TOLERANCE + spread:
+        return registration, tracking
+    moved = registration.moved((dx, dy), rotation)
+    if moved.y_min < y_offset or moved.y_max > y_offset + stretched_image.shape[0]:
+        return registration, tracking
+    # Lit pixels have to fall in the moved LED polygons about as well as they do in the reference
+    reference_coverage = get_lit_coverage(reference_lit, get_led_mask(registration.polygons, (x0, y0), reference.shape))
+    coverage = get_lit_coverage(img_lit, get_led_mask(moved.polygons, (x0, y0), reference.shape))
+    tracking['coverage'] = coverage
+    if coverage is None or reference_coverage is None or coverage < reference_coverage - TRACK_COVERAGE_TOLERANCE:
+        return registration, tracking
+    tracking['drift'] = False
+    return moved, tracking
+
+
+# NEXTA digit for each 4 LED nibble, first LED is the most significant bit, -1 is not a valid digit.
+NEXTA_DIGIT_TABLE = np.full(16, -1, dtype=np.int8)
+NEXTA_DIGIT_TABLE[[0b0000, 0b0001, 0b0010, 0b0100, 0b1000, 0b0011, 0b0110, 0b1100, 0b0111, 0b1111]] = np.arange(10)
+
+# NEXTA error codes, all 20 LEDs packed by pack_led_rows.
+NEXTA_ERROR_CODES = np.array([
+    0b00000000000000000000,  # Powered off
+    0b10100000000000000000,  # Internal clock drift too large
+    0b10101000000000000000,  # GNSS signal lost
+    0b10101010000000000000,  # Initial setup - waiting for GNSS fix
+    0b10101010100000000000,  # Initial setup - measuring internal clock drift
+    0b10101010101000000000   # Initial setup - finished
+])
+
+
+def pack_led_rows(led_on):
+    """
+    Packs each row of LED on/off into an integer, first LED is the most significant of 20 bits. Missing LEDs are off.
+    :param led_on: (rows, up to 20) bool
+    :return: packed LED values
+    :rtype: np.ndarray
+    """
+    weights = np.left_shift(1, 19 - np.arange(led_on.shape[1]), dtype=np.int64)
+    return np.asarray(led_on, dtype=np.int64) @ weights
+
 
+def decode_nexta_times(packed, led_counts, exptime):
+    """
+    Decodes the packed LED values of all rows into time values. Digits are decoded with NEXTA_DIGIT_TABLE, rows
+    with an error code or a first digit that doesn't decode aren't valid.
+    :param packed: LED values from pack_led_rows
+    :param led_counts: Number of LEDs found on each row
+    :param exptime:
+    :return: value, err (maybe least significant figure, exponent), valid, decimals (places shown after the '.',
+             -1 if no '.'), bad_digit (first digit with '?', -1 if none)
+    :rtype: np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray
+    """
+    packed = np.asarray(packed, dtype=np.int64)
+    led_counts = np.asarray(led_counts, dtype=np.int64)
+    best_err = int(math.log(exptime) / math.log(10))
 
-def booleanlist_to_string(ourlist, truechar='1', falsechar='0'):
+    digits = NEXTA_DIGIT_TABLE[(packed[:, np.newaxis] >> np.array([16, 12, 8, 4, 0])) & 0xF]
+    bad = digits < 0
+    has_bad = bad.any(axis=1)
+    bad_digit = np.where(has_bad, np.argmax(bad, axis=1), -1)
+
+    # Precision is from the LEDs on the row, up to the first bad digit, but no better than the exposure time. Done on
+    # the length of the decoded string, like '3.1415'.
+    err = -1 * (led_counts // 4)
+    err = np.where(has_bad, np.maximum(err, -4 * bad_digit), err)
+    decoded_len = np.where(has_bad, np.where(bad_digit == 0, 0, bad_digit + 1), 6)
+    clamped = err < best_err
+    err = np.where(clamped, best_err, err)
+    # Keep the first 2 - err characters, always without a bad digit, only if clamped with one.
+    stop = -1 * err + 2
+    truncated_len = np.where(stop >= 0, np.minimum(decoded_len, stop), np.maximum(decoded_len + stop, 0))
+    decoded_len = np.where(clamped | ~has_bad, truncated_len, decoded_len)
+
+    decimals = np.maximum(decoded_len - 2, 0)
+    decimals = np.where(decoded_len == 1, -1, decimals)
+    # Whole number of the digits we keep, then one division so value is the same as float() of the string.
+    places = np.arange(5)
+    frac = np.maximum(decimals, 0)[:, np.newaxis]
+    whole = np.where(places <= frac, np.maximum(digits, 0) * 10 ** np.maximum(frac - places, 0), 0).sum(axis=1)
+    value = whole / 10.0 ** frac[:, 0]
+
+    valid = (decoded_len > 0) & ~np.isin(packed, NEXTA_ERROR_CODES)
+    value = np.where(valid, value, np.nan)
+    return value, err.astype(np.int8), valid, decimals.astype(np.int8), bad_digit.astype(np.int8)
+
+
+def nexta_value_to_string(value, decimals):
     """
-    Given a boolean list turns it to a string of truechar, or falsechar.
-    :param ourlist: A list
-    :param truechar:
-    :param falsechar:
+    Decoded value as a string, like '3.1415', or '3.' with no decimals.
+    :param value:
+    :param decimals: places after the '.', -1 for no '.'
     :return:
     :rtype: str
     """
-    ourstr = ''
-    for i in ourlist:
-        if i:
-            ourstr += truechar
-        else:
-            ourstr += falsechar
-    return ourstr
+    if decimals < 0:
+        return '%.0f' % value
+    return '%.*f' % (decimals, value) + ('.' if decimals == 0 else '')
 
 
-def decode_nexta_time(led_values, exptime):
+def decoded_row_to_dict(packed, led_count, value, err, decimals, bad_digit):
     """
-    Decodes full array of LED values into a time value.
-    :param led_values:
-    :param exptime:
-    :return: value, led_count, err (maybe least significant figure, exponent)
+    A row from decode_nexta_times as a dict, how timed rows are saved.
+    :return: value string, led_count, err, and lsb, the LEDs from the first bad digit on, if a digit didn't decode
     :rtype: Dict
     """
-    decoded = ''
-    best_err = int(math.log(exptime) / math.log(10))
-    sled_values = booleanlist_to_string(led_values).ljust(20, '0')
-    err, reason = nexta_check_error(sled_values)
-    if err:
-        return None
-    for i in range(0, len(sled_values), 4):
-        digit = str(decode_nexta_digit(sled_values[i:i + 4]))
-        if digit == '?':
-            err = max(-1 * int(len(led_values) / 4.0), -1 * i)
-            if err < best_err:
-                err = best_err
-                decoded = decoded[0:-1 * err + 2]
-            return {'value': decoded, 'err': err, 'led_count': len(led_values),
-                    'lsb': booleanlist_to_string(list(led_values[i:]))}
-        decoded += digit
-        if i == 0:
-            decoded += '.'
-    err = -1 * int(len(led_values) / 4.0)
-    if err < best_err:
-        err = best_err
-    decoded = decoded[0:-1 * err + 2]
-    return {'value': decoded, 'led_count': len(led_values), 'err': err}
-
-
-def get_led_on_threshold(rois, stretched_image, dscale, verbose=0):
+    row = {'value': nexta_value_to_string(value, decimals), 'led_count': led_count, 'err': err}
+    if bad_digit >= 0:
+        row['lsb'] = format(packed, '020b')[4 * bad_digit:led_count]
+    return row
+
+
+# Decoded timing rows, one per image row that decoded to a time
+TIMED_ROW_DTYPE = np.dtype([('y', np.int32), ('value', np.float64), ('err', np.int8), ('led_count', np.int8),
+                            ('decimals', np.int8), ('bad_digit', np.int8), ('packed', np.int32), ('flags', np.uint8)])
+# timed row flags
+TIMED_ROW_BAD_DIGIT = 1
+
+
+def make_timed_rows(ys, packed, led_counts, value, err, decimals, bad_digit):
+    """
+    :return: Structured TIMED_ROW_DTYPE array of the rows, arguments are from get_timing_led_matrix and
+             decode_nexta_times and are already filtered to the valid rows.
+    :rtype: np.ndarray
+    """
+    timed_rows = np.empty(len(ys), dtype=TIMED_ROW_DTYPE)
+    timed_rows['y'] = ys
+    timed_rows['value'] = value
+    timed_rows['err'] = err
+    timed_rows['led_count'] = led_counts
+    timed_rows['decimals'] = decimals
+    timed_rows['bad_digit'] = bad_digit
+    timed_rows['packed'] = packed
+    timed_rows['flags'] = np.where(bad_digit >= 0, TIMED_ROW_BAD_DIGIT, 0)
+    return timed_rows
+
+
+def timed_rows_to_dict(timed_rows):
+    """
+    :param timed_rows: Structured TIMED_ROW_DTYPE array
+    :return: y to the dict form of decoded_row_to_dict, how timed rows are saved
+    :rtype: Dict[int, Dict]
+    """
+    return {row[0]: decoded_row_to_dict(*row[1:]) for row in
+            zip(timed_rows['y'].tolist(), timed_rows['packed'].tolist(), timed_rows['led_count'].tolist(),
+                timed_rows['value'].tolist(), timed_rows['err'].tolist(), timed_rows['decimals'].tolist(),
+                timed_rows['bad_digit'].tolist())}
+
+
+def save_data_to_json(save_data):
+    """
+    :param save_data: Timing from readtime
+    :return: save_data with timed_rows in dict form, ready for json
+    :rtype: Dict
+    """
+    json_data = dict(save_data)
+    json_data['timed_rows'] = timed_rows_to_dict(save_data['timed_rows'])
+    return json_data
+
+
+def get_led_on_threshold(registration, stretched_image, dscale, verbose=0, y_offset=0):
     """
     Tries to get value that if greater than the LED is considered on versus off.
-    :param rois: Polygons where our LEDs are in the image.
+    :param registration: Registration of where our LEDs are in the image.
     :param stretched_image:
     :param dscale:
     :param verbose:
+    :param y_offset: Row of the full image that is stretched_image's first row
     :return:
     :rtype: float
     """
     # Lets get our background to know what is off vs on.
     # TODO: Because of vignetting and possible gradients a better way to know if led on or off, if we support led off frame taken at same exposure time
     # TODO: Would help for reading area where exposure is greater than blinking rate as well.
-    background = []
-    for roi in rois:
-        background.extend(get_poly_values(stretched_image, roi).tolist())
-    background = np.array(background).flatten()
+    background = np.concatenate([registration.get_values(stretched_image, led_idx, y_offset)
+                                 for led_idx in range(len(registration))])
     led_on_thresh = background.mean()
     if verbose >= 1:
         print('Background Mean: ', led_on_thresh)
     if verbose >= 2:
         led_thresh = cv2.threshold(stretched_image, led_on_thresh, 255, cv2.THRESH_BINARY)[1]
         led_thresh = cv2.cvtColor(led_thresh, cv2.COLOR_GRAY2BGR)
-        for poly in rois:
-            cv2.polylines(led_thresh, [np.int32(poly)], True, (255, 0, 0), 2)
+        for poly in registration.polygons:
+            cv2.polylines(led_thresh, [np.int32(poly) - [0, y_offset]], True, (255, 0, 0), 2)
         if verbose >= 2:
             debug_show.show('debug', led_thresh)
             debug_show.wait(5000)
     return led_on_thresh
 
 
-def get_y_roi_range(rois, verbose):
+def get_led_row_sums(y_min, img, band_spans, progress=None):
     """
-    We only need to loop through rows that have the LEDs, so lets find max, min, y rows in our roi
-    :param rois: Our region of interest (polygon where LEDs are in the image).
-    :param verbose:
-    :return: y_min, y_max
-    :rtype: List[int]
+    Sum and pixel count of each LED on each row, for all rows at once. Uses cumulative row sums so each LED row sum is
+    the difference of two lookups, summed a chunk of rows at a time.
+    :param y_min: Lower bound of rows, in img rows
+    :param band_spans: x_start, x_end, in_row for each row and LED from get_band_spans
+    :param progress: Called with a message, rows summed and total rows as each chunk of rows is done, see readtime
+    :return: sums (num_rows, num_leds) and counts (num_rows, num_leds)
+    :rtype: np.ndarray, np.ndarray
+    """
+    x0, x1, in_row = band_spans
+    num_rows = x0.shape[0]
+    counts = x1 - x0
+    # Integers sums stay exact, so means are the same as the mean of the LED's pixels
+    sum_dtype = np.float64 if np.issubdtype(img.dtype, np.floating) else np.int64
+    sums = np.zeros(counts.shape, dtype=sum_dtype)
+    used = counts > 0
+    if not used.any():
+        return sums, counts
+    # Only columns with LEDs need summing
+    col_min = int(x0[used].min())
+    col_max = int(x1[used].max())
+    band = img[y_min:y_min + num_rows, col_min:col_max]
+    x0 = np.where(used, x0 - col_min, 0)
+    x1 = np.where(used, x1 - col_min, 0)
+
+    for start in range(0, num_rows, ROW_CHUNK_SIZE):
+        stop = min(start + ROW_CHUNK_SIZE, num_rows)
+        row_sums = np.zeros((stop - start, band.shape[1] + 1), dtype=sum_dtype)
+        np.cumsum(band[start:stop], axis=1, dtype=sum_dtype, out=row_sums[:, 1:])
+        rows = np.arange(stop - start)[:, np.newaxis]
+        sums[start:stop] = row_sums[rows, x1[start:stop]] - row_sums[rows, x0[start:stop]]
+        if progress is not None:
+            progress('Reading rows', stop, num_rows)
+    return sums, counts
+
+
+def get_led_row_means(y_min, img, band_spans, progress=None):
     """
+    Mean value of each LED on each row, for all rows at once.
+    :param y_min: Lower bound of rows, in img rows
+    :param band_spans: x_start, x_end, in_row for each row and LED from get_band_spans
+    :param progress: Called as rows are read, see get_led_row_sums
+    :return: means (num_rows, num_leds) with nan where LED has no pixels on the row, and sums and counts from
+             get_led_row_sums
+    :rtype: np.ndarray, np.ndarray, np.ndarray
+    """
+    sums, counts = get_led_row_sums(y_min, img, band_spans, progress)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+    means[counts == 0] = np.nan
+    return means, sums, counts
 
-    ys = []
-    for roi in rois:
-        yy = list(zip(*roi))
-        ys.append(max(yy[1]))
-        ys.append(min(yy[1]))
-    y_min = min(ys)
-    y_max = max(ys) + 1
-    if verbose >= 1:
-        print('y range:', y_min, y_max)
-    return y_min, y_max
+
+def get_led_means(sums, counts):
+    """
+    :param sums: LED row sums from get_led_row_sums
+    :param counts: LED row pixel counts from get_led_row_sums
+    :return: Mean of all pixels of each LED
+    :rtype: np.ndarray
+    """
+    return sums.sum(axis=0) / counts.sum(axis=0)
 
 
-def get_timing_led_rows(y_min, y_max, stretched_image, led_on_thresh, rois, verbose=0):
+def get_timing_led_matrix(stretched_image, led_on_thresh, registration, verbose=0, y_offset=0, progress=None):
     """
-    For rows with LEDS array if leds are on.
-    :param y_min: Lower bound of rows to check
-    :param y_max: Greater bound of rows to check
+    LED on/off for all rows that could have timing information, as arrays.
     :param stretched_image: Our image stretched
     :param led_on_thresh: Value that if greater indicate LED is on verses off
-    :param rois: Regions of interest (polygons of leds)
+    :param registration: Registration of our LEDs
     :param verbose: How much debugging output to do
-    :return: A dictionary with row y as key, and value being a list of if LED is on or of 0 or 1
-    :rtype: Dict[int, List[bool]] = List[bool]
+    :param y_offset: Row of the full image that is stretched_image's first row
+    :param progress: Called as rows are read, see readtime
+    :return: ys of timing rows, led_on (len(ys), num_leds - 1), led_count of each timing row, and ms_leds_timed_cols
+    :rtype: np.ndarray, np.ndarray, np.ndarray, Dict[int, List[bool]]
     """
-    # For millisecond LEDs, we want mean of just them
+    y_min = registration.y_min
+    means, sums, counts = get_led_row_means(y_min - y_offset, stretched_image, registration.band_spans, progress)
+    in_row = registration.band_spans[2]
+    # Like the row loops, the last LED isn't used, and we stop counting at the first LED not on the row.
+    leds_in_row = np.cumprod(in_row[:, :-1], axis=1).sum(axis=1)
+    led_on = means[:, :-1] > led_on_thresh
+    # LEDs after the first one not on the row don't count.
+    led_on &= np.arange(led_on.shape[1]) < leds_in_row[:, np.newaxis]
+
+    # If we have at least 12 that is some value to us
+    timing_rows = np.flatnonzero(leds_in_row >= 12)
+
     # If ms LED has part on and off, mean should be a good divider for what is on or off, better than led_on_thresh.
-    led_means = {}
+    ms_leds_timed_cols = {}
+    led_means = get_led_means(sums, counts)
     for led_idx in range(12, 16):
-        led_means[led_idx] = get_poly_values(stretched_image, rois[led_idx]).mean()
-
-    timed_rows = {}
-    ms_leds_timed_cols = {12: [], 13: [], 14: [], 15: []}
+        ms_leds_timed_cols[led_idx] = (means[leds_in_row > led_idx, led_idx] > led_means[led_idx]).tolist()
 
-    # For each row with LED in it
-    for y in range(y_min, y_max):
-        if verbose >= 1:
-            if y % 50 == 0:
-                print('Checking Row', y, end='\r')
-
-        # Get the values of our the intersection of the line and roi poly
-        linemask = np.zeros_like(stretched_image)
-        linemask[y] = np.ones(stretched_image.shape[1])
-        linemask = linemask > 0
-        row_led_in = []
-        row_led_on = []
-        for roi_idx in range(len(rois) - 1):
-            # For each point if row is in the poly.
-            poly_mask = get_poly_mask(stretched_image, rois[roi_idx])
-            and_mask = np.logical_and(linemask, poly_mask)
-            # Is LED on row
-            in_row = np.any(and_mask)
-            row_led_in.append(in_row)
-            if in_row:
-                poly_values = stretched_image[and_mask]
-                pmean = poly_values.mean()
-                digit_led = pmean > led_on_thresh
-                row_led_on.append(digit_led)
-                if roi_idx in ms_leds_timed_cols:
-                    if pmean > led_means[roi_idx]:
-                        ms_leds_timed_cols[roi_idx].append(True)
-                    else:
-                        ms_leds_timed_cols[roi_idx].append(False)
-            else:
-                break
-        # If we have at least 12 that is some value to us
-        if sum(row_led_in) >= 12:
-            timed_rows[y] = row_led_on
     if verbose >= 1:
-        print()
-        print('Possible timing rows: ' + str(len(timed_rows.keys())) + '/' + str(y_max - y_min))
-    return timed_rows, ms_leds_timed_cols
+        print('Possible timing rows: ' + str(len(timing_rows)) + '/' + str(registration.y_max - y_min))
+    return y_min + timing_rows, led_on[timing_rows], leds_in_row[timing_rows], ms_leds_timed_cols
 
 
-def get_timing_led_rows_faster(y_min, y_max, stretched_image, led_on_thresh, rois, verbose=0):
-    """
-    For rows with LEDS array if leds are on.
-    :param y_min: Lower bound of rows to check
-    :param y_max: Greater bound of rows to check
-    :param stretched_image: Our image stretched
-    :param led_on_thresh: Value that if greater indicate LED is on verses off
-    :param rois: Regions of interest (polygons of leds)
-    :param verbose: How much debugging output to do
-    :return: A dictionary with row y as key, and value being a list of if LED is on or of 0 or 1
-    :rtype: Dict[int, List[bool]] = List[bool]
-    """
+# NEXTA time repeats every 10 seconds
+NEXTA_PERIOD = 10.0
+# Rows further than this many robust standard deviations, plus their resolution, from the line of times are outliers
+OUTLIER_SIGMAS = 5.0
+# Rows further than this many seconds from the line are always outliers
+OUTLIER_MAX_DELTA = 1.0
 
-    timed_rows = {}
-    ms_leds_timed_cols = {12: [], 13: [], 14: [], 15: []}
 
-    # For each row with LED in it
-    for y in range(y_min, y_max):
-        if verbose >= 1:
-            if y % 50 == 0:
-                print('Checking Row', y, end='\r')
-
-        # Get the values of our the intersection of the line and roi poly
-        row_led_in = []
-        row_led_on = []
-        for roi_idx in range(len(rois) - 1):
-            # For each point if row is in the poly.
-            px1, py1, px2, py2, ppoly = get_poly_rectangle(rois[roi_idx])
-            # Is LED on row
-            in_row = py1 <= y < py2
-            row_led_in.append(in_row)
-            if in_row:
-                stretched_image_prect = stretched_image[py1:py2, px1:px2]
-                poly_mask = get_poly_mask(stretched_image_prect, ppoly)
-                linemask = np.zeros_like(stretched_image_prect)
-                linemask[y - py1] = np.ones(stretched_image_prect.shape[1])
-                linemask = linemask > 0
-                and_mask = np.logical_and(linemask, poly_mask)
-                poly_values = stretched_image_prect[and_mask]
-                pmean = poly_values.mean()
-                digit_led = pmean > led_on_thresh
-                row_led_on.append(digit_led)
-                if roi_idx in ms_leds_timed_cols:
-                    # If ms LED has part on and off, mean should be a good divider for what is on or off, better than led_on_thresh.
-                    led_mean = get_poly_values(stretched_image_prect, ppoly).mean()
-                    if pmean > led_mean:
-                        ms_leds_timed_cols[roi_idx].append(True)
-                    else:
-                        ms_leds_timed_cols[roi_idx].append(False)
-            else:
-                break
-        # If we have at least 12 that is some value to us
-        if sum(row_led_in) >= 12:
-            timed_rows[y] = row_led_on
-    if verbose >= 1:
-        print()
-        print('Possible timing rows: ' + str(len(timed_rows.keys())) + '/' + str(y_max - y_min))
-    return timed_rows, ms_leds_timed_cols
+def unwrap_times(values):
+    """
+    Takes times out of NEXTA's 10 second cycle by putting each within half a cycle of the typical time of the rows.
+    Unlike unwrapping in row order, one misread row can't move the rows after it by a whole cycle. The rows of a frame
+    have to span less than half a cycle.
+    :param values: Row times, 0 to 10s
+    :return: Times, within 5s of the median time
+    :rtype: np.ndarray
+    """
+    if len(values) == 0:
+        return np.asarray(values, dtype=np.float64)
+    # Circular mean first, a plain median of times around the 10s to 0s wrap would be in the middle of the cycle
+    angles = 2 * np.pi * values / NEXTA_PERIOD
+    ref = np.angle(np.exp(1j * angles).mean()) * NEXTA_PERIOD / (2 * np.pi)
+    times = values - NEXTA_PERIOD * np.round((values - ref) / NEXTA_PERIOD)
+    # Median so the reference doesn't lean towards misread rows
+    ref = np.median(times)
+    return values - NEXTA_PERIOD * np.round((values - ref) / NEXTA_PERIOD)
 
 
 def filter_outliers(timed_rows, fits_header_nextatime, verbose=0):
     """
-    Filter outliers likely on the top and bottom rows of our roi where roi is slight off our LEDs, or image too noisy
-    :param timed_rows: Timing data
+    Filter outliers likely on the top and bottom rows of our roi where roi is slight off our LEDs, or image too noisy.
+    Times are unwrapped from NEXTA's 10 second cycle with unwrap_times, rows far from a robust line of time versus row
+    are removed, then rows that go against the direction of time are removed. A row's value is truncated, the time is
+    anywhere from value to value + 10^-decimals, so rows only count as out of order if those ranges don't overlap.
+    :param timed_rows: Timing data, structured TIMED_ROW_DTYPE array
     :param fits_header_nextatime:
     :param verbose: How much debug output to do.
-    :return: Cleaner timed rows.
+    :return: Cleaner timed rows, and if time decreases as y increases
     """
-    # TODO: This is a mess, clean it up, bad rows can decode valid often.
-    orig_row_count = len(timed_rows.keys())
+    orig_row_count = len(timed_rows)
 
-    # Difference between rows is too great, likely missing seconds LEDs
     # First lets see if we are increasing or decreasing as y increases
-    last_y_value = None
-    delta_t = []
-    vs = []
-    possible_wraps = [False, False]
-    for y in timed_rows.keys():
-        v = float(timed_rows[y]['value'])
-        vs.append(v)
-        if v < 0.2:
-            possible_wraps[0] = True
-        if v > 9.8:
-            possible_wraps[1] = True
-        if last_y_value is not None:
-            delta_t.append(last_y_value - v)
-        last_y_value = v
-    delta_t = np.array(delta_t)
+    delta_t = -np.diff(timed_rows['value'])
     increasing = (delta_t > 0).sum() > (delta_t < 0).sum()
-
-    # Find mean time adjusted for 10s wrap
-    vs = []
-    wrapped = False
-    mean_v = None
-    to_del = []
-    for i in range(2):
-        for y in timed_rows.keys():
-            v = float(timed_rows[y]['value'])
-            orig_v = v
-            if last_y_value:
-                if increasing:
-                    if wrapped and v < 1.0:
-                        v += 10
-                    elif last_y_value > 9.8 and v < 0.2:
-                        v += 10
-                        wrapped = True
-                    else:
-                        wrapped = False
-                else:
-                    if wrapped and v > 9.0:
-                        v -= 10
-                    if last_y_value < 0.2 and v > 9.8:
-                        v -= 10
-                        wrapped = True
-                    else:
-                        wrapped = False
-            vs.append(v)
-            if mean_v is not None:
-                if abs(v - mean_v) > 1.0:
-                    to_del.append(y)
-            last_y_value = orig_v
-        mean_v = np.array(vs).mean()
-        # print(mean_v)
-
-    deleted_from_mean = len(to_del)
-    for y in to_del:
-        del timed_rows[y]
-
-    # We can do better but for now we'll just throw out any non-monotonic inc or dec
-    last_y_value = None
-    to_del = []
-    for y in timed_rows.keys():
-        v = float(timed_rows[y]['value'])
-        orig_v = v
-        if last_y_value is not None:
-            if increasing:
-                if last_y_value > 9.8 and v < 0.2:
-                    v += 10
-            else:
-                if last_y_value < 0.2 and v > 9.8:
-                    v -= 10
-            delta_t = last_y_value - v
-            # print(y, delta_t)
-            if increasing and delta_t < 0 or not increasing and delta_t > 0:
-                to_del.append(y)
-        last_y_value = orig_v
-
-    deleted_non_monotonic = len(to_del)
-    for y in to_del:
-        del timed_rows[y]
+    if orig_row_count < 2:
+        return timed_rows, increasing
+
+    times = unwrap_times(timed_rows['value'])
+    ys = timed_rows['y'].astype(np.float64)
+    resolution = 10.0 ** -np.maximum(timed_rows['decimals'], 0)
+
+    # Slope from pairs of rows half the rows apart, a long baseline so the truncation of values hardly matters
+    half = orig_row_count // 2
+    slope = np.median((times[half:2 * half] - times[:half]) / (ys[half:2 * half] - ys[:half]))
+    residuals = times - slope * ys
+    residuals -= np.median(residuals)
+    sigma = 1.4826 * np.median(np.abs(residuals))
+    keep = np.abs(residuals) <= np.minimum(OUTLIER_MAX_DELTA, OUTLIER_SIGMAS * sigma + resolution)
+    deleted_from_mean = int((~keep).sum())
+    timed_rows, times, resolution = timed_rows[keep], times[keep], resolution[keep]
+
+    # Each row's time range has to overlap the time we are already past
+    if increasing:
+        keep = times <= np.minimum.accumulate(times + resolution)
+    else:
+        keep = times + resolution >= np.maximum.accumulate(times)
+    deleted_non_monotonic = int((~keep).sum())
+    timed_rows = timed_rows[keep]
 
     if verbose >= 1:
-        print('Filtered rows: ', orig_row_count - len(timed_rows.keys()), 'because mean:', deleted_from_mean,
+        print('Filtered rows: ', orig_row_count - len(timed_rows), 'because mean:', deleted_from_mean,
               'because non-monotonic', deleted_non_monotonic)
     return timed_rows, increasing
 
 
-def get_digit_at_place(value, exp):
-    return value // (10 ** exp) % 10
+# Normal distribution 95% confidence interval half width in standard deviations
+CI95_SIGMAS = 1.96
+# How many standard deviations the fitted row time has to be from 0 to be a rolling shutter
+ROLLING_SHUTTER_SIGMAS = 3.0
 
 
-def calculate_stats(rolling_shutter_times, timed_rows, increasing, rows, fits_header_nextatime, verbose=0):
+def fit_time_per_row(timed_rows):
+    """
+    Weighted least squares line of time versus row. Values are truncated to their resolution, the larger of 10^err and
+    their last decimal place, so the middle of each row's time range is fit with a uniform error of that resolution.
+    The covariance is scaled up when the rows scatter more than their resolution explains.
+    :param timed_rows: Structured TIMED_ROW_DTYPE array, filtered by filter_outliers
+    :return: time at row 0, time per row, their variances and covariance. Times are unwrapped from the 10s cycle.
+    :rtype: (float, float, float, float, float)
+    """
+    ys = timed_rows['y'].astype(np.float64)
+    resolution = np.maximum(10.0 ** timed_rows['err'], 10.0 ** -np.maximum(timed_rows['decimals'], 0))
+    times = unwrap_times(timed_rows['value']) + resolution / 2
+    weights = 12 / resolution ** 2
+
+    weight_sum = weights.sum()
+    y_mean = (weights * ys).sum() / weight_sum
+    t_mean = (weights * times).sum() / weight_sum
+    syy = (weights * (ys - y_mean) ** 2).sum()
+    if syy == 0:
+        # All on one row, nothing to say about time per row
+        return t_mean, 0.0, 1 / weight_sum, np.inf, 0.0
+    slope = (weights * (ys - y_mean) * (times - t_mean)).sum() / syy
+    intercept = t_mean - slope * y_mean
+
+    dof = len(ys) - 2
+    scale = 1.0
+    if dof > 0:
+        scale = max(1.0, (weights * (times - intercept - slope * ys) ** 2).sum() / dof)
+    var_slope = scale / syy
+    var_intercept = scale * (1 / weight_sum + y_mean ** 2 / syy)
+    cov = -scale * y_mean / syy
+    return intercept, slope, var_intercept, var_slope, cov
+
+
+def is_rolling_slope(slope, var_slope):
+    """
+    :return: True if time changes with row more than the fit's uncertainty, see fit_time_per_row
+    :rtype: bool
+    """
+    return abs(slope) > ROLLING_SHUTTER_SIGMAS * math.sqrt(var_slope)
+
+
+def wrap_pixel_time(pixel_time, fits_header_nextatime):
+    """
+    Puts a fitted time in the same 10s cycle as the fits header time.
+    """
+    pixel_time = pixel_time % NEXTA_PERIOD
+    if fits_header_nextatime >= 8 and pixel_time <= 2:
+        pixel_time = 10 + pixel_time
+    return pixel_time
+
+
+def calculate_stats(rolling_shutter_times, timed_rows, rows, fits_header_nextatime, verbose=0):
     """
     Tries to calculate some statistics about our timing, like how off the fits timestamp is, rolling shutter roll readout time, etc.
-    :param rolling_shutter_times:
-    :param timed_rows:
-    :param increasing:
-    :param rows:
+    Times come from a weighted fit of all timed rows, see fit_time_per_row, and have 95% confidence interval half widths
+    in the _ci95 keys. The frame is ROLLING only if the fitted time per row is significant, the row time from the
+    millisecond LEDs doesn't decide that and is only kept as ms_led_row_time.
+    :param rolling_shutter_times: Row times from get_rolling_shutter_times
+    :param timed_rows: Structured TIMED_ROW_DTYPE array, filtered by filter_outliers
+    :param rows: Rows in the full image
     :param fits_header_nexatime:
     :param verbose:
     :return: Dict[str, float]
     """
-
-    last_y = None
-    row_deltas = []
-    first_err_row = None
-    last_err_row = None
-    last_v = None
-
-    best_rows = []
-    # Generate some stats
-    for y in timed_rows.keys():
-        # For stats, lets try to only use values with 10^-4 or better resolution
-        if timed_rows[y]['err'] <= -4:
-            best_rows.append({'y': y, 'value': float(timed_rows[y]['value']), 'err': timed_rows[y]['err']})
-
+    if len(timed_rows) == 0:
+        raise Exception('No timed rows to calculate stats from')
     rst = np.array(rolling_shutter_times)
     rst = rst[rst != np.array(None)]
+    ms_led_row_time = float(rst.mean()) if rst.shape[0] > 0 else None
+
+    intercept, slope, var_intercept, var_slope, cov = fit_time_per_row(timed_rows)
+    if verbose >= 1:
+        print('Time fit: ', intercept, '+', slope, '* row', 'sigma:', math.sqrt(var_intercept),
+              math.sqrt(var_slope), 'ms LED row time:', ms_led_row_time)
+    # Only when time changes with row more than the fit's uncertainty, the millisecond LEDs can match noise on a
+    # global shutter.
+    is_rolling = is_rolling_slope(slope, var_slope)
+
     rst_mean = None
-    first_pixel_time = None
-    last_pixel_time = None
     full_readout_time = None
-    if rst.shape[0] > 0 and len(best_rows) >= 0:
-        rst_mean = rst.mean()
-        # In an effort to get more accurate timing, lets use first row that increments.
-        increment_rows = []
-        last_row: None | Dict[str, float] = None
-        for row in best_rows:
-            if last_row is not None:
-                row_diff = abs(last_row['y'] - row['y'])
-                err_diff = last_row['err'] == row['err']
-                lerr_place = get_digit_at_place(last_row['value'], row['err'] + 1)
-                err_place = get_digit_at_place(row['value'], row['err'] + 1)
-                err_place_diff = int(abs(lerr_place - err_place))
-                # print('DEBUG: ', row_diff, err_diff, err_place_diff)
-                if row_diff == 1 and err_diff and (err_place_diff == 1 or err_place_diff == 9):
-                    increment_rows.append([last_row, row])
-            last_row = row
-        # print('inc rows:', len(increment_rows), len(increment_rows) >= 0)
-        if len(increment_rows) >= 0:
-            # print('DEBUG: Using an inc row')
-            irows = increment_rows[int(len(increment_rows) / 2.0 + 0.5)]
-            if irows[0]['value'] - irows[1]['value'] > 0:
-                row = irows[0]
-            else:
-                row = irows[1]
-        else:
-            # Couldn't get increment row, so lets just use a middle best row
-            # print('DEBUG: Using plain middle row')
-            row = best_rows[int(len(best_rows) / 2.0 + 0.5)]
-        first_pixel_time = row['value'] - rst_mean * row['y']
-        last_pixel_time = row['value'] + rst_mean * (rows - row['y'])
-        if first_pixel_time < 0 or fits_header_nextatime >= 8 and first_pixel_time <= 2:
-            first_pixel_time = 10 + first_pixel_time
-        if last_pixel_time < 0 or fits_header_nextatime >= 8 and last_pixel_time <= 2:
-            last_pixel_time = 10 + last_pixel_time
+    rst_ci95 = None
+    full_readout_ci95 = None
+    if is_rolling:
+        shutter_type = 'ROLLING'
+        rst_mean = abs(slope)
+        rst_ci95 = CI95_SIGMAS * math.sqrt(var_slope)
+        # Time at the top edge of row 0 and bottom edge of the last row, first pixel is whichever is earlier.
+        edge_rows = [0, rows] if slope >= 0 else [rows, 0]
+        edge_times = [intercept + slope * r for r in edge_rows]
+        edge_ci95 = [CI95_SIGMAS * math.sqrt(var_intercept + r ** 2 * var_slope + 2 * r * cov) for r in edge_rows]
+        first_pixel_time = wrap_pixel_time(edge_times[0], fits_header_nextatime)
+        last_pixel_time = first_pixel_time + edge_times[1] - edge_times[0]
+        first_pixel_ci95, last_pixel_ci95 = edge_ci95
         full_readout_time = last_pixel_time - first_pixel_time
-    if verbose >= 1:
-        print('First pixel Time: ', first_pixel_time, 'Last pixel time: ', last_pixel_time, 'Full readout time:',
-              full_readout_time)
-    # If first_pixel_time is None, either we have bad data, or is global shutter.
-    if first_pixel_time is None:
+        full_readout_ci95 = rows * rst_ci95
+    else:
+        # If global shutter every row has the same time, the weighted mean of the rows.
         shutter_type = 'GLOBAL'
-        # If global shutter we'll use some middle timed row
-        timed_rows_list = list(timed_rows.values())
-        first_pixel_time = float(timed_rows_list[int(len(timed_rows_list) / 2.0 + 0.5)]['value'])
+        resolution = np.maximum(10.0 ** timed_rows['err'], 10.0 ** -np.maximum(timed_rows['decimals'], 0))
+        times = unwrap_times(timed_rows['value']) + resolution / 2
+        weights = 1 / resolution ** 2
+        first_pixel_time = wrap_pixel_time((weights * times).sum() / weights.sum(), fits_header_nextatime)
         last_pixel_time = first_pixel_time
-        if first_pixel_time < 0 or fits_header_nextatime >= 8 and first_pixel_time <= 2:
-            first_pixel_time = 10 + first_pixel_time
-        if last_pixel_time < 0 or fits_header_nextatime >= 8 and last_pixel_time <= 2:
-            last_pixel_time = 10 + last_pixel_time
-        fits_delta = first_pixel_time - fits_header_nextatime
-    else:
-        shutter_type = 'ROLLING'
-        fits_delta = first_pixel_time - fits_header_nextatime
+        first_pixel_ci95 = CI95_SIGMAS * math.sqrt(1 / (12 * weights.sum()))
+        last_pixel_ci95 = first_pixel_ci95
+    fits_delta = first_pixel_time - fits_header_nextatime
     if verbose >= 1:
+        print('First pixel Time: ', first_pixel_time, 'Last pixel time: ', last_pixel_time, 'Full readout time:',
+              full_readout_time)
         print('Fits DATE-OBS adjustment needed: ', fits_delta)
 
     return {'shutter_type': shutter_type, 'rolling_shutter_row_time': rst_mean,
             'calc_first_pixel': first_pixel_time, 'fits_time': fits_header_nextatime, 'fits_delta': fits_delta,
-            'calc_last_pixel': last_pixel_time, 'full_readout_time': full_readout_time}
-
-
-def list_has_pattern(ourlist, pattern):
-    pattern_idx = 0
-    # print('list_has_pattner', ourlist, pattern)
-    for item in ourlist:
-        # print('lhp:', item, pattern[pattern_idx])
-        if item == pattern[pattern_idx]:
-            pattern_idx += 1
-            if pattern_idx == len(pattern):
-                return True
-        elif item == pattern[0]:
-            pattern_idx = 1
-            if pattern_idx == len(pattern):
-                return True
-        else:
-            pattern_idx = 0
-    return False
+            'calc_last_pixel': last_pixel_time, 'full_readout_time': full_readout_time,
+            'rolling_shutter_row_time_ci95': rst_ci95, 'calc_first_pixel_ci95': first_pixel_ci95,
+            'calc_last_pixel_ci95': last_pixel_ci95, 'full_readout_time_ci95': full_readout_ci95,
+            'ms_led_row_time': ms_led_row_time}
 
 
-def list_has_looping_pattern(ourlist, pattern):
-    for i in range(len(pattern)):
-        if list_has_pattern(ourlist, pattern[i:] + pattern[:i]):
-            return True
-    return False
+def find_looping_pattern(values, pattern):
+    """
+    Finds the first place values has the pattern, starting anywhere in the pattern and wrapping around. Windows of
+    values and rotations of the pattern are hashed as exact base len(pattern) + 2 numbers, so it is one linear pass.
+    :param values: list or array of non-negative ints
+    :param pattern: list of positive ints
+    :return: (index in values where the match starts, index in pattern it starts at), or None if no match
+    """
+    m = len(pattern)
+    values = np.asarray(values, dtype=np.int64)
+    if m == 0 or len(values) < m:
+        return None
+    # Values bigger than any in the pattern can't match, one sentinel digit for all of them keeps the hash exact
+    max_pattern = max(pattern)
+    base = max_pattern + 2
+    digits = np.minimum(values, max_pattern + 1)
+    powers = base ** np.arange(m - 1, -1, -1, dtype=np.int64)
+    window_hashes = np.lib.stride_tricks.sliding_window_view(digits, m) @ powers
+    rotations = np.array([pattern[i:] + pattern[:i] for i in range(m)], dtype=np.int64)
+    rotation_hashes = rotations @ powers
+    matches = np.isin(window_hashes, rotation_hashes)
+    if not matches.any():
+        return None
+    position = int(np.argmax(matches))
+    phase = int(np.flatnonzero(rotation_hashes == window_hashes[position])[0])
+    return position, phase
 
 
-def get_rolling_shutter_times(ms_led_timed_cols, increasing, verbose=0):
+def get_run_lengths(values):
     """
-    Calculates rolling shutter time using millisecond LEDs vertical pattern.
-    :param ms_led_timed_cols:
+    Run length encoding.
+    :param values: 1d array
+    :return: value of each run, length of each run
+    :rtype: np.ndarray, np.ndarray
+    """
+    values = np.asarray(values)
+    if len(values) == 0:
+        return values, np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(values)) + 1))
+    return values[starts], np.diff(np.append(starts, len(values)))
+
+
+# Millisecond LED on/off patterns, alternate, starting with on. ex, 12 is: 1on, 4off, 1on, 2off, 1on 1off
+# One complete pattern is 10ms
+MILLISECOND_PATTERNS = {
+    12: [1, 4, 1, 2, 1, 1],
+    13: [1, 2, 4, 3],
+    14: [1, 2, 2, 1, 2, 2],
+    15: [1, 3, 1, 2, 2, 1]
+}
+
+
+def get_ms_led_pattern_matches(ms_led_timed_cols, increasing, verbose=0):
+    """
+    Finds the millisecond LED patterns in the on/off runs of rows of each millisecond LED.
+    :param ms_led_timed_cols: Dict of LED index to on/off of each row
     :param increasing:
     :param verbose:
-    :return:
+    :return: Dict of LED index to None if the pattern wasn't found, or a dict of the row time, 'row' of the band where
+             the match starts, and 'phase', index in the pattern (reversed if not increasing) the match starts at.
     """
-    # As long as the LED has part on and off, mean should be a good divider for what is on or off.
-    # alternate, starting with on. ex, 12 is: 1on, 4off, 1on, 2off, 1on 1off
-    # One complete pattern is 10ms
-    millisecond_patterns = {
-        12: [1, 4, 1, 2, 1, 1],
-        13: [1, 2, 4, 3],
-        14: [1, 2, 2, 1, 2, 2],
-        15: [1, 3, 1, 2, 2, 1]
-    }
-    if not increasing:
-        # If we are not increasing we need to reverse the patterns.
-        for led_idx in millisecond_patterns.keys():
-            millisecond_patterns[led_idx].reverse()
-
-    # The 10^3 LEDS are index 12-15
-    rolling_shutter_times = []
-    for led_idx, pattern in millisecond_patterns.items():
+    matches = {}
+    for led_idx, pattern in MILLISECOND_PATTERNS.items():
+        if not increasing:
+            # If we are not increasing we need to reverse the patterns.
+            pattern = pattern[::-1]
         # We need to combine all the True and Falses into how many consecutive rows are true and false
-        row_counts = []
-        count = 1
-        last_v = None
-        for row_on in ms_led_timed_cols[led_idx]:
-            if last_v is not None:
-                if row_on == last_v:
-                    count += 1
-                else:
-                    row_counts.append(count)
-                    count = 1
-            last_v = row_on
-        row_counts.append(count)
+        _, row_counts = get_run_lengths(np.asarray(ms_led_timed_cols[led_idx], dtype=bool))
         if verbose >= 1:
-            print('MS Pattern counts', led_idx, row_counts)
+            print('MS Pattern counts', led_idx, row_counts.tolist())
+        if len(row_counts) == 0:
+            matches[led_idx] = None
+            continue
         # Lets convert them to patterns
         # Lets assume max count is max in the pattern
-        unit = max(row_counts) / float(max(millisecond_patterns[led_idx]))
-        row_units = np.array(row_counts) / unit
-        if verbose >= 1:
-            print('MS Pattern Units', led_idx, row_units.tolist())
-        row_units = np.int32(row_units + 0.5)
+        unit = row_counts.max() / float(max(pattern))
+        row_units = np.int32(row_counts / unit + 0.5)
         if verbose >= 1:
             print('MS Patterns Casted', led_idx, row_units)
-        if list_has_looping_pattern(row_units.tolist(), pattern):
-            # Per rolling shutter row time is 1ms/unit
-            rolling_shutter_times.append(0.001 / unit)
+        match = find_looping_pattern(row_units, pattern)
+        if match is None:
+            matches[led_idx] = None
         else:
-            rolling_shutter_times.append(None)
+            # Per rolling shutter row time is 1ms/unit
+            matches[led_idx] = {'row_time': 0.001 / unit, 'row': int(row_counts[:match[0]].sum()), 'phase': match[1]}
+    return matches
+
+
+def get_rolling_shutter_times(ms_led_timed_cols, increasing, verbose=0):
+    """
+    Calculates rolling shutter time using millisecond LEDs vertical pattern.
+    :param ms_led_timed_cols:
+    :param increasing:
+    :param verbose:
+    :return: Row time from each millisecond LED, None for LEDs that didn't have their pattern
+    """
+    matches = get_ms_led_pattern_matches(ms_led_timed_cols, increasing, verbose)
+    rolling_shutter_times = [None if match is None else match['row_time'] for match in matches.values()]
     if verbose >= 1:
         print('Rolling Shutter Times:', rolling_shutter_times)
     return rolling_shutter_times
 
 
-def readtime(stretched_image, rois, date_obs, exptime, dscale=-1, verbose=0):
-    led_on_thresh = get_led_on_threshold(rois, stretched_image, dscale, verbose)
+# NEXTA LED code of each digit
+NEXTA_DIGIT_CODES = np.zeros(10, dtype=np.int64)
+NEXTA_DIGIT_CODES[NEXTA_DIGIT_TABLE[NEXTA_DIGIT_TABLE >= 0]] = np.flatnonzero(NEXTA_DIGIT_TABLE >= 0)
+# On/off of the millisecond LEDs, 12-15, for each millisecond digit
+MS_LED_BITS = (NEXTA_DIGIT_CODES[np.newaxis, :] >> np.arange(3, -1, -1)[:, np.newaxis]) & 1
+# Millisecond units a bin of the row time search covers is 1/MS_BINS_PER_UNIT
+MS_BINS_PER_UNIT = 4
+# Rows per block of row times searched at once, bounds memory on tall LED bands
+MS_SEARCH_BLOCK = 128
+# Matched filter score, 1 is a perfect match, needed to trust the millisecond LED row time
+MS_MIN_SCORE = 0.5
+# Transitions needed to refine the row time
+MS_MIN_TRANSITIONS = 4
+
+
+def get_ms_led_signals(stretched_image, registration, y_offset=0):
+    """
+    Brightness of the millisecond LEDs on each row they are on, scaled so on is about 1 and off about -1.
+    :param stretched_image: Our image stretched, full image or band of rows
+    :param registration: Registration of our LEDs
+    :param y_offset: Row of the full image that is stretched_image's first row
+    :return: Dict of LED index to rows (full image y) and signal
+    :rtype: Dict[int, (np.ndarray, np.ndarray)]
+    """
+    x0, x1, in_row = registration.band_spans
+    ms_spans = (x0[:, 12:16], x1[:, 12:16], in_row[:, 12:16])
+    means, sums, counts = get_led_row_means(registration.y_min - y_offset, stretched_image, ms_spans)
+    led_means = get_led_means(sums, counts)
+    signals = {}
+    for i, led_idx in enumerate(range(12, 16)):
+        rows = np.flatnonzero(in_row[:, 12 + i])
+        # As long as the LED has part on and off, mean should be a good divider for what is on or off.
+        x = means[rows, i] - led_means[i]
+        scale = np.median(np.abs(x)) if len(x) > 0 else 0
+        signal = np.clip(x / scale, -1, 1) if scale > 0 else np.zeros(len(x))
+        signals[led_idx] = (registration.y_min + rows, signal)
+    return signals
+
+
+def estimate_ms_led_row_time(ms_led_signals, verbose=0):
+    """
+    Row time from the millisecond LEDs. The LEDs' on/off for each millisecond digit comes from the NEXTA digit table, a
+    matched filter over all four LEDs searches rows per millisecond, phase and direction. Per row, the time binned into
+    quarter milliseconds is correlated with each LED's pattern by FFT. The best match is then refined to sub-row
+    precision by a least squares line through the rows where the LEDs turn on or off.
+    :param ms_led_signals: From get_ms_led_signals
+    :param verbose: How much debugging output to do
+    :return: None if the LEDs don't show the pattern, or dict of row_time in seconds, row_time_sigma, direction (1 if
+             time increases with y), phase (milliseconds at y = 0, mod 10) and score
+    :rtype: Dict[str, float]
+    """
+    bins = 10 * MS_BINS_PER_UNIT
+    leds = [(ys, signal, MS_LED_BITS[led_idx - 12]) for led_idx, (ys, signal) in ms_led_signals.items()
+            if len(ys) > 0]
+    if len(leds) == 0:
+        return None
+    all_ys = np.concatenate([ys for ys, _, _ in leds])
+    span = all_ys.max() - all_ys.min() + 1
+
+    # The longest on or off runs in the patterns are 3 and 4ms, the longer runs we see give the range to search.
+    # Search only row times where the band sees at least 2ms, and the shortest millisecond is at least 2 rows.
+    run_lengths = np.concatenate([get_run_lengths(signal > 0)[1] for _, signal, _ in leds])
+    long_run = float(np.percentile(run_lengths, 90))
+    units_min = max(2.0 / span, 1.5 / long_run)
+    units_max = min(0.5, 5.0 / long_run)
+    if units_min >= units_max:
+        return None
+    # Phase drifts half a bin over the band between steps
+    units_grid = np.arange(units_min, units_max, 0.5 / (MS_BINS_PER_UNIT * span))
+
+    templates = []
+    perfect = 0.0
+    for ys, signal, bits in leds:
+        template = np.repeat(2.0 * bits - 1, MS_BINS_PER_UNIT)
+        template -= template.mean()
+        templates.append(np.fft.rfft(template))
+        perfect += (np.abs(signal) * (1 - (2 * bits.mean() - 1) ** 2)).sum()
+
+    best = (-np.inf, 0, 0, 1)
+    for direction in (1, -1):
+        for start in range(0, len(units_grid), MS_SEARCH_BLOCK):
+            units = units_grid[start:start + MS_SEARCH_BLOCK]
+            scores = np.zeros((len(units), bins))
+            for (ys, signal, bits), template in zip(leds, templates):
+                time_bins = np.floor(direction * units[:, np.newaxis] * ys * MS_BINS_PER_UNIT).astype(np.int64) % bins
+                flat = (np.arange(len(units))[:, np.newaxis] * bins + time_bins).ravel()
+                hist = np.bincount(flat, weights=np.broadcast_to(signal, time_bins.shape).ravel(),
+                                   minlength=len(units) * bins).reshape(len(units), bins)
+                scores += np.fft.irfft(np.conj(np.fft.rfft(hist, axis=1)) * template, n=bins, axis=1)
+            idx = np.unravel_index(np.argmax(scores), scores.shape)
+            if scores[idx] > best[0]:
+                best = (scores[idx], units[idx[0]], idx[1] / MS_BINS_PER_UNIT, direction)
+    score = best[0] / perfect if perfect > 0 else 0
+    if verbose >= 1:
+        print('MS LED matched filter: score', score, 'ms per row', best[1], 'phase', best[2], 'direction', best[3])
+    if score < MS_MIN_SCORE:
+        return None
+
+    # Rows where an LED turns on or off are millisecond boundaries, the ones the LED changes at, fit them to a line.
+    _, units, phase, direction = best
+    boundary_ys = []
+    boundaries = []
+    for ys, signal, bits in leds:
+        on = signal > 0
+        changes = np.flatnonzero((np.diff(on) != 0) & (np.diff(ys) == 1))
+        y_change = ys[changes] + 0.5
+        boundary = np.round(phase + direction * units * y_change)
+        # Boundary n is between digit n - 1 and n
+        led_changes = bits[(boundary.astype(np.int64) - 1) % 10] != bits[boundary.astype(np.int64) % 10]
+        boundary_ys.append(y_change[led_changes])
+        boundaries.append(boundary[led_changes])
+    boundary_ys = np.concatenate(boundary_ys)
+    boundaries = np.concatenate(boundaries)
+    if len(boundaries) < MS_MIN_TRANSITIONS or len(np.unique(boundaries)) < 2:
+        return None
+    y_mean = boundary_ys.mean()
+    syy = ((boundary_ys - y_mean) ** 2).sum()
+    slope = ((boundary_ys - y_mean) * (boundaries - boundaries.mean())).sum() / syy
+    intercept = boundaries.mean() - slope * y_mean
+    residuals = boundaries - intercept - slope * boundary_ys
+    # A change is only known to the row, at least that much error
+    variance = max((residuals ** 2).sum() / max(1, len(boundaries) - 2), slope ** 2 / 12)
+    slope_sigma = math.sqrt(variance / syy)
+    if verbose >= 1:
+        print('MS LED transitions:', len(boundaries), 'ms per row', slope, '+-', slope_sigma)
+    return {'row_time': abs(slope) * 0.001, 'row_time_sigma': slope_sigma * 0.001, 'direction': 1 if slope > 0 else -1,
+            'phase': intercept % 10, 'score': score}
+
+
+def readtime(stretched_image, registration, date_obs, exptime, dscale=-1, verbose=0, y_offset=0, rows=None,
+             track=False, progress=None):
+    """
+    Reads the time from an image of our LEDs.
+    :param stretched_image: Our image stretched, full image or a band of rows from open_fits_band
+    :param registration: Registration, or list of LED polygons
+    :param date_obs: DATE-OBS from fits header
+    :param exptime: EXPTIME from fits header
+    :param dscale: debug scaling value
+    :param verbose: How much debugging output to do
+    :param y_offset: Row of the full image that is stretched_image's first row
+    :param rows: Rows in the full image, defaults to rows in stretched_image
+    :param track: Move the LED polygons to where the LED band is in this image, see track_registration
+    :param progress: Called with a message, and for rows read also how many of how many, between steps. Raise from it
+                     to stop reading, like jobs.Job.progress does when cancelled.
+    :return: timed_rows, as a structured TIMED_ROW_DTYPE array, and timing stats. See save_data_to_json.
+    :rtype: Dict
+    """
+    if not isinstance(registration, Registration):
+        registration = Registration(registration)
+    if rows is None:
+        rows = stretched_image.shape[0]
+    tracking = None
+    if track:
+        if progress is not None:
+            progress('Tracking LED band')
+        registration, tracking = track_registration(registration, stretched_image, y_offset)
+        if verbose >= 1:
+            print('tracking:', tracking)
+    if registration.y_min < y_offset or registration.y_max > y_offset + stretched_image.shape[0]:
+        raise Exception('Image does not have the rows of the registration')
+    if progress is not None:
+        progress('Finding LED threshold')
+    led_on_thresh = get_led_on_threshold(registration, stretched_image, dscale, verbose, y_offset)
 
-    y_min, y_max = get_y_roi_range(rois, verbose)
+    if verbose >= 1:
+        print('y range:', registration.y_min, registration.y_max)
 
-    timed_rows, ms_leds_timed_cols = get_timing_led_rows_faster(y_min, y_max, stretched_image, led_on_thresh, rois,
-                                                                verbose)
+    ys, led_on, led_counts, ms_leds_timed_cols = get_timing_led_matrix(stretched_image, led_on_thresh, registration,
+                                                                       verbose, y_offset, progress)
 
     # Decode each row on/off LEDs
-    decode_failed_rows = 0
-    for y in list(timed_rows.keys()):
-        timed_rows[y] = decode_nexta_time(timed_rows[y], exptime)
-        if timed_rows[y] is None:
-            decode_failed_rows += 1
-            del timed_rows[y]
+    if progress is not None:
+        progress('Decoding rows')
+    packed = pack_led_rows(led_on)
+    values, errs, valid, decimals, bad_digits = decode_nexta_times(packed, led_counts, exptime)
+    timed_rows = make_timed_rows(ys[valid], packed[valid], led_counts[valid], values[valid], errs[valid],
+                                 decimals[valid], bad_digits[valid])
+    decode_failed_rows = int((~valid).sum())
     if verbose >= 1:
         print('Rows failed to decode: ', decode_failed_rows)
 
@@ -688,57 +1412,118 @@ def readtime(stretched_image, rois, date_obs, exptime, dscale=-1, verbose=0):
     fits_header_nextatime = float(fits_seconds) % 10
     if verbose >= 1:
         print('Fits Seconds: ', date_obs, fits_seconds, float(fits_seconds) % 10)
-        print('Found ', len(timed_rows.keys()), 'Timing Rows')
+        print('Found ', len(timed_rows), 'Timing Rows')
 
     timed_rows, increasing = filter_outliers(timed_rows, fits_header_nextatime, verbose)
-    rolling_shutter_times = get_rolling_shutter_times(ms_leds_timed_cols, increasing, verbose)
+    if progress is not None:
+        progress('Finding row time')
+    ms_led_estimate = estimate_ms_led_row_time(get_ms_led_signals(stretched_image, registration, y_offset), verbose)
+    rolling_shutter_times = []
+    if ms_led_estimate is not None:
+        rolling_shutter_times = [ms_led_estimate['row_time']]
+    elif len(timed_rows) >= 2:
+        # Matched filter didn't find it, maybe pattern of run lengths will. They can match noise on a global shutter, so
+        # only when the timed rows show time changing with row.
+        _, slope, _, var_slope, _ = fit_time_per_row(timed_rows)
+        if is_rolling_slope(slope, var_slope):
+            rolling_shutter_times = get_rolling_shutter_times(ms_leds_timed_cols, increasing, verbose)
 
     # Calculate rolling shutter time
-    timing_stats = calculate_stats(rolling_shutter_times, timed_rows, increasing, stretched_image.shape[0],
-                                   fits_header_nextatime, verbose)
+    timing_stats = calculate_stats(rolling_shutter_times, timed_rows, rows, fits_header_nextatime, verbose)
+    timing_stats['ms_led_row_time_ci95'] = None
+    if ms_led_estimate is not None:
+        timing_stats['ms_led_row_time_ci95'] = CI95_SIGMAS * ms_led_estimate['row_time_sigma']
     save_data = {'timed_rows': timed_rows}
     save_data.update(timing_stats)
+    save_data['tracking'] = tracking
     return save_data
 
 
-def run(roi_json_path, fits_path, output_fn, dscale=-1, verbose=0):
-    with open(roi_json_path) as f:
-        rois = json.load(f)
+def run(registration, fits_path, output_fn, dscale=-1, verbose=0, band_only=False, raw=False, store=None,
+        track=False):
+    """
+    Reads time from a fits file and saves it.
+    :param registration: Registration, or path to a registration file
+    :param fits_path: fits image to read
+    :param output_fn: Where to save the timing json, None to not save json
+    :param dscale: debug scaling value
+    :param verbose: How much debugging output to do
+    :param band_only: Only read and stretch the rows of the LED band, stretch levels then only come from those rows
+    :param raw: Read time from the fits data as is, without stretching it. Only reads the rows of the LED band.
+    :param store: result_store.ResultStore to also add the timing to
+    :param track: Correct small movement of the LED band since registration
+    :return: The saved timing data
+    :rtype: Dict
+    """
+    if not isinstance(registration, Registration):
+        registration = Registration.load(registration)
 
-    # TODO: Support multichannel/bayer images
-    img, date_obs, exptime = open_fits(fits_path)
-    stretched_image = np.uint8(Stretch().stretch(img) * 255)
+    if band_only or raw:
+        img, y_offset, rows, header = open_fits_band(fits_path, registration.y_min, registration.y_max)
+        date_obs, exptime = header['DATE-OBS'], header['EXPTIME']
+    else:
+        img, date_obs, exptime = open_fits(fits_path)
+        y_offset, rows = 0, img.shape[0]
+    if raw:
+        # Thresholds and LED means work on any values, stretching only loses dim LED contrast of 16bit data.
+        timing_image = img
+    else:
+        timing_image = np.uint8(Stretch().stretch(img) * 255)
     if dscale > 0:
         dscale = dscale
     else:
-        dscale = 1000 / max(stretched_image.shape)
+        dscale = 1000 / max(rows, timing_image.shape[1])
 
     if verbose >= 2:
-        debug_show.show('debug', stretched_image)
+        debug_show.show('debug', timing_image)
         debug_show.wait(10000)
     if verbose >= 1:
-        print('stretched_image', stretched_image.shape, stretched_image.dtype)
+        print('timing_image', timing_image.shape, timing_image.dtype)
 
-    save_data = readtime(stretched_image, rois, date_obs, exptime, dscale, verbose)
+    save_data = readtime(timing_image, registration, date_obs, exptime, dscale, verbose, y_offset, rows, track)
 
-    with open(output_fn, 'w') as f:
-        json.dump(save_data, f, indent=4)
+    if output_fn is not None:
+        with open(output_fn, 'w') as f:
+            json.dump(save_data_to_json(save_data), f, indent=4)
+    if store is not None:
+        store.add_frame(fits_path, date_obs, exptime, save_data)
+    return save_data
 
 
 def add_parser_args(parser):
     parser.add_argument('--image', '-i', required=True, type=str,
                         help='FiTS image to read')
-    parser.add_argument('--output', '-o', required=True, type=str, help='Output of time data')
+    parser.add_argument('--output', '-o', required=False, type=str, default=None, help='Output of time data')
+    parser.add_argument('--store', type=str, required=False, default=None,
+                        help='Also add time data to this result store file, created if needed')
     parser.add_argument('--scale', '-s', type=float, required=False, default=-1,
                         help='How much to scale manual area selection image or debug images, defaults to an calculated reasonable value to fit on screen')
     parser.add_argument('--registration', '-r', required=True, type=str,
                         help="Path to registration file created by led_selector")
+    parser.add_argument('--band-only', action='store_true',
+                        help='Only read and stretch the rows of the image with LEDs, faster on large images. The stretch '
+                             'is from those rows only, so times can differ a little from reading the whole image')
+    parser.add_argument('--raw', action='store_true',
+                        help='Read time from the image data as is without stretching, only reads rows with LEDs')
+    parser.add_argument('--track', action='store_true',
+                        help='Follow small movement of the LED band since registration, needs a registration file with a reference')
     parser.add_argument('--verbose', '-v', action='count', default=0,
                         help='How much debug info, -v for text, -vv for graphical debug info')
 
 
 def main(args):
-    run(args.registration, args.image, args.output, args.scale, verbose=args.verbose)
+    if args.output is None and args.store is None:
+        raise Exception('Need --output or --store to save time data')
+    store = None
+    if args.store is not None:
+        import result_store
+        store = result_store.ResultStore(args.store)
+    try:
+        run(args.registration, args.image, args.output, args.scale, verbose=args.verbose, band_only=args.band_only,
+            raw=args.raw, store=store, track=args.track)
+    finally:
+        if store is not None:
+            store.close()
 
 
 def main_cli():
@@ -14,11 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import json
+import multiprocessing
 import os.path
 import pathlib
-import queue
 import sys
-import threading
 import tkinter
 import traceback
 from tkinter import Tk, Menu, filedialog, BOTH, Frame, messagebox, Label, StringVar, Entry
@@ -26,10 +25,14 @@ from tkinter import Tk, Menu, filedialog, BOTH, Frame, messagebox, Label, String
 import cv2
 import numpy as np
 import sigfig
-from auto_stretch.stretch import Stretch
 
+import batch
+import jobs
 import led_selector
 import read_time
+import tk_queue
+import watch
+from running_stats import FrameStats
 from NACanvas import NACanvas
 
 
@@ -43,17 +46,18 @@ class ReadTimeGUI:
         self.__state = {
             'image': {'DATE-OBS': None, 'EXPTIME': None, 'date': None, 'path': None, 'data': None, 'working': None},
             'registration': {'path': None, 'name': None, 'data': None},
-            'timinginfo': {'path': None, 'name': None, 'data': None}
+            'timinginfo': {'path': None, 'name': None, 'data': None},
+            # Stats of every image timed this session, images are only counted once
+            'session': {'stats': FrameStats(), 'paths': set()}
         }
-        self.work_queue = queue.Queue()
-        self.gui_queue = queue.Queue()
-        self.work_thread = threading.Thread(target=work_loop, args=(self.work_queue, self.gui_queue))
-        self.work_thread.start()
+        # Changes each time a different image is shown, jobs started for an older one have their results dropped
+        self.__image_generation = 0
+        self.gui_queue = tk_queue.TkQueue(self.__master)
+        self.jobs = jobs.JobManager(self.run_in_gui)
 
         self.__setup_menu()
         self.__setup_statusbar()
         self.__setup_canvas()
-        self.__master.after(50, self.__process_gui_queue)
 
     def __setup_menu(self):
         menubar = Menu(self.__master)
@@ -73,6 +77,8 @@ class ReadTimeGUI:
         self.actionmenu.add_command(label="Auto-register", command=self.__autoregister, state=tkinter.DISABLED)
         self.actionmenu.add_command(label="Manual-register", command=self.__manualregister, state=tkinter.DISABLED)
         self.actionmenu.add_command(label="Read Time", command=self.__readtime, state=tkinter.DISABLED)
+        self.actionmenu.add_separator()
+        self.actionmenu.add_command(label="Cancel", command=self.__cancel_jobs, state=tkinter.DISABLED)
 
         menubar.add_cascade(label="Action", menu=self.actionmenu)
         # Help
@@ -101,13 +107,17 @@ class ReadTimeGUI:
         self.__firstrow_strvar = StringVar()
         self.__lastrow_strvar = StringVar()
         self.__fullread_strvar = StringVar()
+        self.__sessionframes_strvar = StringVar()
+        self.__sessiondelta_strvar = StringVar()
         table = [['Header Start:', self.__dateobs_strvar],
                  ['Header Delta:', self.__headerdelta_strvar],
                  ['Shutter Type:', self.__shuttertype_strvar],
                  ['Row Time:', self.__rowreadout_strvar],
                  ['First Row:', self.__firstrow_strvar],
                  ['Last Row:', self.__lastrow_strvar],
-                 ['Full Read:', self.__fullread_strvar]]
+                 ['Full Read:', self.__fullread_strvar],
+                 ['Session Images:', self.__sessionframes_strvar],
+                 ['Session Delta:', self.__sessiondelta_strvar]]
         for row_idx in range(len(table)):
             print(row_idx, table[row_idx])
             a = Label(self.__frame2, text=table[row_idx][0])
@@ -137,8 +147,8 @@ class ReadTimeGUI:
 
     def __on_exit(self):
         # TODO: Any saving warnings?
+        self.jobs.shutdown()
         self.gui_queue.put(('quit',))
-        self.work_queue.put(('quit',))
         self.__master.destroy()
 
     def __open_image(self):
@@ -150,15 +160,17 @@ class ReadTimeGUI:
 
         f = filedialog.askopenfile(mode='rb', title="Open Image", filetypes=[("FITS files", '.fit .fits'), ("All files", '.*')])
         if f is not None:
-            self.run_in_work(open_image, self.__set_imagedata, error, f)
+            # Only the last image opened gets shown
+            self.jobs.cancel('open_image')
+            self.run_in_work('open_image', open_image, self.__set_imagedata, error, f)
             self.__set_statusbar("Loading Image...")
 
     def __open_registration(self):
         f = filedialog.askopenfile(mode='rb', title="Open Registration", filetypes=[("Registration files", '.etreg'), ("All files", '.*')])
         if f is not None:
             try:
-                j = json.load(f)
-                self.__update_overlay(j, self.__state['image']['data'], f.name)
+                registration = read_time.Registration.load(f)
+                self.__update_overlay(registration, self.__state['image']['data'], f.name)
             except Exception as e:
                 traceback.print_exception(e)
                 self.__error_dialog('Error loading registration file.')
@@ -173,7 +185,7 @@ class ReadTimeGUI:
                                              filetypes=[('Timing files', '.ettime')])
         if f is not None:
             try:
-                json.dump(self.__state['timinginfo']['data'], f)
+                json.dump(read_time.save_data_to_json(self.__state['timinginfo']['data']), f)
                 self.__state['timinginfo']['path'] = f.name
                 self.__state['timinginfo']['name'] = os.path.basename(f.name)
             finally:
@@ -183,7 +195,7 @@ class ReadTimeGUI:
         f = tkinter.filedialog.asksaveasfile(title='Save Registration As', filetypes=[('Timing files', '.etreg')])
         if f is not None:
             try:
-                json.dump(self.__state['registration']['data'], f)
+                self.__state['registration']['data'].save(f)
                 self.__state['registration']['path'] = f.name
                 self.__state['registration']['name'] = os.path.basename(f.name)
             finally:
@@ -198,7 +210,7 @@ class ReadTimeGUI:
             self.__update_image()
 
 
-    def __update_overlay(self, reg_json, img, path):
+    def __update_overlay(self, registration, img, path):
         def error(e):
             traceback.print_exception(e)
             self.__clear_registration()
@@ -209,12 +221,14 @@ class ReadTimeGUI:
         def success(w):
             self.__state['image']['working'] = w
             self.__canvas.set_image(w)
-            self.__state['registration'] = {'path': path, 'name': os.path.basename(path), 'data': reg_json}
+            self.__state['registration'] = {'path': path, 'name': os.path.basename(path), 'data': registration}
             self.actionmenu.entryconfig('Read Time', state=tkinter.NORMAL)
             self.filemenu.entryconfig("Save Registration As", state=tkinter.NORMAL)
             self.__update_image()
 
-        self.run_in_work(update_overlay, success, error, reg_json, img)
+        # Jobs can finish out of order, only the newest registration's overlay gets shown
+        self.jobs.cancel('update_overlay')
+        self.run_in_work('update_overlay', update_overlay, success, error, registration, img)
 
     def __update_image(self):
         if self.__state['image']['working'] is None:
@@ -226,34 +240,10 @@ class ReadTimeGUI:
     def __error_dialog(self, message):
         tkinter.messagebox.showerror(title='Error', message=message)
 
-    def __process_gui_queue(self):
-        is_quit = False
-        try:
-            command = self.gui_queue.get(0)
-            if command[0] == 'quit':
-                is_quit = True
-            else:
-                args = []
-                kwargs = {}
-                method = command[0]
-                if len(command) > 1:
-                    args = command[1]
-                if len(command) > 2:
-                    kwargs = command[2]
-                if args is not None:
-                    # print(args, kwargs)
-                    method(*args, **kwargs)
-                else:
-                    method()
-        except queue.Empty:
-            pass
-        except Exception as e:
-            traceback.print_exc()
-        finally:
-            if not is_quit:
-                self.__master.after(50, self.__process_gui_queue)
-
     def __set_imagedata(self, data, working, dateobs, exptime, path):
+        # Work on the image that was shown is no longer wanted
+        self.jobs.cancel(tag=self.__image_generation)
+        self.__image_generation += 1
         self.__clear_table()
         self.__state['image']['path'] = path
         self.__state['image']['name'] = os.path.basename(path)
@@ -267,7 +257,7 @@ class ReadTimeGUI:
         self.actionmenu.entryconfig('Auto-register', state=tkinter.NORMAL)
         self.actionmenu.entryconfig('Manual-register', state=tkinter.NORMAL)
         self.filemenu.entryconfig("Save Registration As", state=tkinter.DISABLED)
-        if self.__state['registration']['data']:
+        if self.__state['registration']['data'] is not None:
             self.__update_overlay(self.__state['registration']['data'], data, self.__state['registration']['path'])
         else:
             self.__update_image()
@@ -278,15 +268,22 @@ class ReadTimeGUI:
             self.__set_statusbar('')
             self.__error_dialog('Failed to auto register, you can try manual.')
 
-        def success(points):
-            self.__update_overlay(points, self.__state['image']['data'], 'memory')
+        def success(registration):
+            self.__update_overlay(registration, self.__state['image']['data'], 'memory')
 
         self.__set_statusbar('Running autoregister...')
-        self.run_in_work(autoregister, success, error, self.__state['image']['data'])
+        self.jobs.cancel('autoregister')
+        self.run_in_work('autoregister', autoregister, success, error, self.__state['image']['data'])
 
     def __on_rois_done(self, polygons):
-        self.__state['registration']['data'] = polygons
-        self.__update_overlay(polygons, self.__state['image']['data'], 'memory')
+        try:
+            registration = read_time.Registration.from_image(polygons, self.__state['image']['data'])
+        except Exception as e:
+            traceback.print_exception(e)
+            self.__error_dialog('Invalid LED polygons.')
+            return
+        self.__state['registration']['data'] = registration
+        self.__update_overlay(registration, self.__state['image']['data'], 'memory')
 
     def __on_rois_abort(self):
         self.__set_statusbar('')
@@ -326,98 +323,113 @@ class ReadTimeGUI:
         def success(timinginfo):
             self.__set_statusbar('')
             self.__state['timinginfo'] = {'data': timinginfo, 'path': None, 'name': 'memory'}
-            self.__headerdelta_strvar.set(str(sigfig.round(timinginfo['fits_delta'], 6)))
+            self.__headerdelta_strvar.set(format_time(timinginfo['fits_delta'], timinginfo['calc_first_pixel_ci95']))
             self.__shuttertype_strvar.set(timinginfo['shutter_type'])
-            self.__rowreadout_strvar.set(str(sigfig.round(timinginfo['rolling_shutter_row_time'], 6)))
-            self.__firstrow_strvar.set(str(sigfig.round(timinginfo['calc_first_pixel'], 6)))
-            self.__lastrow_strvar.set(str(sigfig.round(timinginfo['calc_last_pixel'], 6)))
-            self.__fullread_strvar.set(str(sigfig.round(timinginfo['full_readout_time'], 6)))
+            self.__rowreadout_strvar.set(format_time(timinginfo['rolling_shutter_row_time'],
+                                                     timinginfo['rolling_shutter_row_time_ci95']))
+            self.__firstrow_strvar.set(format_time(timinginfo['calc_first_pixel'], timinginfo['calc_first_pixel_ci95']))
+            self.__lastrow_strvar.set(format_time(timinginfo['calc_last_pixel'], timinginfo['calc_last_pixel_ci95']))
+            self.__fullread_strvar.set(format_time(timinginfo['full_readout_time'],
+                                                   timinginfo['full_readout_time_ci95']))
             self.filemenu.entryconfig("Save Timing As", state=tkinter.NORMAL)
+            self.__update_session(timinginfo)
 
         self.__set_statusbar('Reading time...')
-        self.run_in_work(readtime, success, error, self.__state['image']['data'], self.__state['registration']['data'],
-                         self.__state['image']['DATE-OBS'], self.__state['image']['EXPTIME'])
+        self.jobs.cancel('readtime')
+        self.run_in_work('readtime', readtime, success, error, self.__state['image']['data'],
+                         self.__state['registration']['data'], self.__state['image']['DATE-OBS'],
+                         self.__state['image']['EXPTIME'])
+
+    def __update_session(self, timinginfo):
+        session = self.__state['session']
+        path = self.__state['image']['path']
+        if path in session['paths']:
+            return
+        session['paths'].add(path)
+        session['stats'].add(timinginfo)
+        delta_stats = session['stats'].stats['fits_delta']
+        self.__sessionframes_strvar.set(str(session['stats'].frames))
+        if delta_stats.count > 0:
+            self.__sessiondelta_strvar.set(str(sigfig.round(delta_stats.mean, 6)) + ' ± ' +
+                                           str(sigfig.round(delta_stats.stdev(), 2)))
+
+    def __cancel_jobs(self):
+        if len(self.jobs.cancel()) > 0:
+            self.__set_statusbar('Cancelled')
+        self.actionmenu.entryconfig('Cancel', state=tkinter.DISABLED)
+
+    def __is_current_image(self, generation):
+        return generation == self.__image_generation
+
+    def __on_job_progress(self, job, message, done, total):
+        if job.is_cancelled() or not self.__is_current_image(job.tag):
+            return
+        if total:
+            message += ' ' + str(done) + '/' + str(total)
+        self.__set_statusbar(job.name + ' #' + str(job.id) + ': ' + message)
+
+    def __on_job_done(self, job):
+        if len(self.jobs.get_jobs()) == 0:
+            self.actionmenu.entryconfig('Cancel', state=tkinter.DISABLED)
 
     def set_status(self, message):
         self.run_in_gui(self.__set_statusbar, message)
 
-    def run_in_work(self, work_method, successcb, errorcb, *args, **kwargs):
-        self.work_queue.put((work_method, successcb, errorcb, args, kwargs))
+    def run_in_work(self, name, work_method, successcb, errorcb, *args, **kwargs):
+        """
+        Runs work_method as a job for the image shown now, its callbacks are dropped if another image is shown before
+        it is done.
+        :return: The job
+        :rtype: jobs.Job
+        """
+        self.actionmenu.entryconfig('Cancel', state=tkinter.NORMAL)
+        return self.jobs.submit(name, work_method, successcb, errorcb, *args, tag=self.__image_generation,
+                                progresscb=self.__on_job_progress, donecb=self.__on_job_done,
+                                is_current=self.__is_current_image, **kwargs)
 
     def run_in_gui(self, gui_method, *args, **kwargs):
         self.gui_queue.put((gui_method, args, kwargs))
 
 
-def work_loop(work_queue, gui_queue):
+def format_time(value, ci95):
     """
-    :param work_queue: 0 - method, 1 - successcb, 2 - errorcb, 3 - args, 4 - kwargs
-    :param gui_queue:
-    :return:
+    :return: value rounded to its 95% confidence interval, like '3.41234 ± 0.00001', or '' if there is no value
     """
-    command = ('',)
-    errorcb = None
-    while True:
-        try:
-            command = work_queue.get()
-            args = []
-            kwargs = {}
-            successcb = None
-            errorcb = None
-            method = None
-            if len(command) > 0:
-                method = command[0]
-            if len(command) > 1:
-                successcb = command[1]
-            if len(command) > 2:
-                errorcb = command[2]
-            if len(command) > 3:
-                args = command[3]
-            if len(command) > 4:
-                kwargs = command[4]
-
-            if method == 'quit':
-                break
-            ret = method(*args, **kwargs)
-            if successcb:
-                gui_queue.put((successcb, ret))
-        except Exception as e:
-            if errorcb is not None:
-                gui_queue.put((errorcb, (e,)))
-            else:
-                traceback.print_exc()
-        finally:
-            errorcb = None
-            if command[0] == 'quit':
-                print('Quitting work loop.')
-                return
-
-
-def update_overlay(reg_json, img):
-    if img is not None and reg_json is not None:
+    if value is None:
+        return ''
+    if not ci95:
+        return str(sigfig.round(value, 6))
+    return str(sigfig.round(value, ci95, cutoff=29))
+
+
+def update_overlay(registration, img, progress=None):
+    if img is not None and registration is not None:
         w = np.array(
             cv2.cvtColor(
-                led_selector.draw_ordered_led_polys(img, reg_json, 0.25),
+                led_selector.draw_ordered_led_polys(img, registration.to_json(), 0.25),
                 cv2.COLOR_BGR2RGB), dtype=np.uint8)
         return (w,)
 
 
-def open_image(fileobj):
+def open_image(fileobj, progress=None):
     try:
         img, dateobs, exptime = read_time.open_fits(fileobj)
-        stretched_image = np.uint8(Stretch().stretch(img) * 255)
+        if progress is not None:
+            progress('Stretching image')
+        stretched_image = read_time.stretch_image(img)
         working = np.array(cv2.cvtColor(stretched_image, cv2.COLOR_GRAY2RGB), dtype=np.uint8)
         return stretched_image, working, dateobs, exptime, fileobj.name
     finally:
         fileobj.close()
 
 
-def autoregister(img):
-    points = led_selector.find_ordered_LED_polypoints(img, 1.0, 0)
-    return (points,)
+def autoregister(img, progress=None):
+    points = led_selector.find_ordered_LED_polypoints(img, 1.0, 0, progress)
+    return (read_time.Registration.from_image(points, img),)
 
 
-def readtime(img, regjson, dateobs, exptime):
-    return (read_time.readtime(img, regjson, dateobs, exptime),)
+def readtime(img, registration, dateobs, exptime, progress=None):
+    return (read_time.readtime(img, registration, dateobs, exptime, progress=progress),)
 
 
 def main():
@@ -439,14 +451,24 @@ def main_cli():
     led_selector.add_parser_args(regparser)
     readtime_parser = subparsers.add_parser('readtime', help="Read time info from image.")
     read_time.add_parser_args(readtime_parser)
+    batch_parser = subparsers.add_parser('batch', help="Read time info from many images in parallel.")
+    batch.add_parser_args(batch_parser)
+    watch_parser = subparsers.add_parser('watch', help="Read time info from images as they are saved to a directory.")
+    watch.add_parser_args(watch_parser)
     args = parser.parse_args()
     if args.subparser == 'registration':
         led_selector.main(args)
     elif args.subparser == 'readtime':
         read_time.main(args)
+    elif args.subparser == 'batch':
+        batch.main(args)
+    elif args.subparser == 'watch':
+        watch.main(args)
     else:
         main()
 
 
 if __name__ == '__main__':
+    # Worker processes of frozen executables
+    multiprocessing.freeze_support()
     sys.exit(main_cli())
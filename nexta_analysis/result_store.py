@@ -0,0 +1,231 @@
+# Exposure Timing - NEXTA Analysis
+# Copyright (C) 2024 Russell Valentine
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import read_time
+from running_stats import FrameStats
+
+# Timing values of each frame, same keys as read_time.readtime gives
+FRAME_COLUMNS = ('shutter_type', 'rolling_shutter_row_time', 'calc_first_pixel', 'fits_time', 'fits_delta',
+                 'calc_last_pixel', 'full_readout_time', 'rolling_shutter_row_time_ci95', 'calc_first_pixel_ci95',
+                 'calc_last_pixel_ci95', 'full_readout_time_ci95', 'ms_led_row_time', 'ms_led_row_time_ci95')
+# Per row arrays of read_time.TIMED_ROW_DTYPE, saved as one little-endian blob per frame and field
+ROW_FIELDS = read_time.TIMED_ROW_DTYPE.names
+# Kept in PRAGMA user_version, stores with another version are not opened
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    date_obs TEXT,
+    exptime REAL,
+    shutter_type TEXT,
+    rolling_shutter_row_time REAL,
+    calc_first_pixel REAL,
+    fits_time REAL,
+    fits_delta REAL,
+    calc_last_pixel REAL,
+    full_readout_time REAL,
+    rolling_shutter_row_time_ci95 REAL,
+    calc_first_pixel_ci95 REAL,
+    calc_last_pixel_ci95 REAL,
+    full_readout_time_ci95 REAL,
+    ms_led_row_time REAL,
+    ms_led_row_time_ci95 REAL,
+    drift INTEGER,
+    tracking TEXT,
+    added REAL
+);
+CREATE INDEX IF NOT EXISTS frames_date_obs ON frames (date_obs);
+CREATE TABLE IF NOT EXISTS frame_rows (
+    frame_id INTEGER PRIMARY KEY REFERENCES frames (id) ON DELETE CASCADE,
+    row_count INTEGER,
+    y BLOB,
+    value BLOB,
+    err BLOB,
+    led_count BLOB,
+    decimals BLOB,
+    bad_digit BLOB,
+    packed BLOB,
+    flags BLOB
+);
+'''
+
+
+def get_field_dtype(field):
+    return read_time.TIMED_ROW_DTYPE[field].newbyteorder('<')
+
+
+class ResultStore:
+    """
+    Timing results of many frames in one SQLite file. Frame timing values are columns of the frames table so they can
+    be queried across a session, decoded rows are kept as compact arrays.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: SQLite file, created if it does not exist
+        """
+        self.path = path
+        # Batch workers each have their own connection, wait on each other's writes
+        self.__conn = sqlite3.connect(path, timeout=60)
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__conn.execute('PRAGMA foreign_keys=ON')
+        self.__check_schema()
+
+    def __check_schema(self):
+        """
+        Makes the tables in a new store. Stores with another schema, like ones from before SCHEMA_VERSION was kept,
+        aren't opened, their rows wouldn't have all the fields.
+        """
+        version = self.__conn.execute('PRAGMA user_version').fetchone()[0]
+        if version == 0:
+            if self.__conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'frames'").fetchone():
+                self.close()
+                raise Exception('Result store is from an older version, read the frames again into a new store: ' +
+                                self.path)
+            with self.__conn:
+                self.__conn.executescript(SCHEMA)
+                self.__conn.execute('PRAGMA user_version = ' + str(SCHEMA_VERSION))
+        elif version != SCHEMA_VERSION:
+            self.close()
+            raise Exception('Result store is schema ' + str(version) + ', not ' + str(SCHEMA_VERSION) + ': ' +
+                            self.path)
+
+    def close(self):
+        self.__conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_frame(self, fits_path, date_obs, exptime, save_data):
+        """
+        Adds or replaces the timing of a frame.
+        :param fits_path: The fits file the timing is from
+        :param date_obs: DATE-OBS from fits header
+        :param exptime: EXPTIME from fits header
+        :param save_data: Timing from read_time.readtime
+        :return: frame id
+        """
+        timed_rows = save_data['timed_rows']
+        tracking = save_data.get('tracking')
+        drift = int(bool(tracking['drift'])) if tracking else None
+        with self.__conn:
+            self.__conn.execute('DELETE FROM frames WHERE path = ?', (os.path.abspath(fits_path),))
+            cur = self.__conn.execute(
+                'INSERT INTO frames (path, date_obs, exptime, ' + ', '.join(FRAME_COLUMNS) +
+                ', drift, tracking, added) VALUES (' + ', '.join(['?'] * (len(FRAME_COLUMNS) + 6)) + ')',
+                [os.path.abspath(fits_path), date_obs, exptime] + [save_data[c] for c in FRAME_COLUMNS] +
+                [drift, json.dumps(tracking, default=float) if tracking else None, time.time()])
+            frame_id = cur.lastrowid
+            self.__conn.execute(
+                'INSERT INTO frame_rows (frame_id, row_count, ' + ', '.join(ROW_FIELDS) + ') VALUES (' +
+                ', '.join(['?'] * (len(ROW_FIELDS) + 2)) + ')',
+                [frame_id, len(timed_rows)] +
+                [timed_rows[field].astype(get_field_dtype(field)).tobytes() for field in ROW_FIELDS])
+        return frame_id
+
+    def get_frames(self, where='', params=()):
+        """
+        :param where: Optional SQL condition on the frames table, like 'fits_delta > ?'
+        :param params: Parameters of the condition
+        :return: List of dicts of frame timing values, ordered by DATE-OBS. drift is 1 if the LED band moved too far to
+                 track, NULL if the frame wasn't tracked, tracking is the tracking info of read_time.track_registration.
+        """
+        sql = 'SELECT id, path, date_obs, exptime, ' + ', '.join(FRAME_COLUMNS) + ', drift, tracking FROM frames'
+        if where:
+            sql += ' WHERE ' + where
+        cur = self.__conn.execute(sql + ' ORDER BY date_obs', params)
+        names = [d[0] for d in cur.description]
+        frames = [dict(zip(names, row)) for row in cur]
+        for frame in frames:
+            if frame['tracking'] is not None:
+                frame['tracking'] = json.loads(frame['tracking'])
+        return frames
+
+    def get_column(self, column, where='', params=()):
+        """
+        :param column: One of FRAME_COLUMNS
+        :param where: Optional SQL condition on the frames table
+        :param params: Parameters of the condition
+        :return: numpy array of the column for all matching frames, ordered by DATE-OBS. NULL values are NaN.
+        """
+        if column not in FRAME_COLUMNS or column == 'shutter_type':
+            raise Exception('Not a numeric frame column: ' + column)
+        sql = 'SELECT ' + column + ' FROM frames'
+        if where:
+            sql += ' WHERE ' + where
+        values = [row[0] for row in self.__conn.execute(sql + ' ORDER BY date_obs', params)]
+        return np.array(values, dtype=np.float64)
+
+    def get_timed_rows(self, frame_id):
+        """
+        :param frame_id: id of the frame
+        :return: The frame's decoded rows, structured read_time.TIMED_ROW_DTYPE array
+        :rtype: np.ndarray
+        """
+        row = self.__conn.execute('SELECT row_count, ' + ', '.join(ROW_FIELDS) + ' FROM frame_rows WHERE frame_id = ?',
+                                  (frame_id,)).fetchone()
+        if row is None:
+            raise Exception('No rows for frame: ' + str(frame_id))
+        timed_rows = np.zeros(row[0], dtype=read_time.TIMED_ROW_DTYPE)
+        for field, blob in zip(ROW_FIELDS, row[1:]):
+            timed_rows[field] = np.frombuffer(blob, dtype=get_field_dtype(field))
+        return timed_rows
+
+    def get_frame_id(self, fits_path):
+        row = self.__conn.execute('SELECT id FROM frames WHERE path = ?', (os.path.abspath(fits_path),)).fetchone()
+        if row is None:
+            raise Exception('Frame not in store: ' + fits_path)
+        return row[0]
+
+    def get_save_data(self, frame_id):
+        """
+        :param frame_id: id of the frame
+        :return: The frame's timing in the form of read_time.readtime
+        :rtype: Dict
+        """
+        frame = self.get_frames('id = ?', (frame_id,))[0]
+        save_data = {'timed_rows': self.get_timed_rows(frame_id)}
+        save_data.update({c: frame[c] for c in FRAME_COLUMNS})
+        save_data['tracking'] = frame['tracking']
+        return save_data
+
+    def export_ettime(self, frame_id, output_fn):
+        """
+        Saves a frame's timing as an .ettime json file.
+        """
+        with open(output_fn, 'w') as f:
+            json.dump(read_time.save_data_to_json(self.get_save_data(frame_id)), f, indent=4)
+
+    def get_frame_stats(self, where='', params=()):
+        """
+        :return: FrameStats of the matching frames
+        """
+        frame_stats = FrameStats()
+        for frame in self.get_frames(where, params):
+            frame_stats.add(frame)
+        return frame_stats
@@ -0,0 +1,190 @@
+# Exposure Timing - NEXTA Analysis
+# Copyright (C) 2024 Russell Valentine
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import math
+
+# Values we keep stats of across frames
+FRAME_STAT_KEYS = ('fits_delta', 'rolling_shutter_row_time', 'full_readout_time')
+# Quantiles estimated for each value
+QUANTILES = {'p05': 0.05, 'median': 0.5, 'p95': 0.95}
+
+
+class P2Quantile:
+    """
+    Estimates a quantile of a stream of values with the P-square algorithm (Jain and Chlamtac, 1985).
+    The first EXACT_COUNT values are kept and give exact quantiles, after that only five markers are kept no matter how
+    many values are added.
+    """
+    EXACT_COUNT = 64
+
+    def __init__(self, p):
+        """
+        :param p: Quantile to estimate, between 0 and 1
+        """
+        self.p = p
+        self.count = 0
+        self.values = []
+        # Marker fractions of the way through the sorted values
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+        self.heights = None
+        # Marker positions, 1 based like the paper
+        self.positions = None
+        self.desired = None
+
+    def add(self, x):
+        self.count += 1
+        if self.count <= self.EXACT_COUNT:
+            bisect.insort(self.values, x)
+            if self.count == self.EXACT_COUNT:
+                self.__init_markers()
+            return
+        h = self.heights
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= h[k + 1]:
+                k += 1
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                hp = self.__parabolic(i, d)
+                if h[i - 1] < hp < h[i + 1]:
+                    h[i] = hp
+                else:
+                    h[i] = h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+                n[i] += d
+
+    def __init_markers(self):
+        last = len(self.values) - 1
+        self.desired = [1 + f * last for f in self.increments]
+        self.positions = [int(round(d)) for d in self.desired]
+        self.heights = [self.values[n - 1] for n in self.positions]
+        self.values = []
+
+    def __parabolic(self, i, d):
+        h = self.heights
+        n = self.positions
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+                (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i]) +
+                (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        """
+        :return: Quantile estimate, None if no values have been added
+        """
+        if self.count == 0:
+            return None
+        if self.count < self.EXACT_COUNT:
+            return self.values[int(round(self.p * (self.count - 1)))]
+        return self.heights[2]
+
+
+class RunningStats:
+    """
+    Count, min, max, mean and standard deviation (Welford's method) and quantile estimates of a stream of values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.quantiles = {name: P2Quantile(p) for name, p in QUANTILES.items()}
+
+    def add(self, x):
+        x = float(x)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+        for quantile in self.quantiles.values():
+            quantile.add(x)
+
+    def stdev(self):
+        """
+        :return: Population standard deviation, like numpy's std()
+        """
+        if self.count == 0:
+            return None
+        return math.sqrt(self.m2 / self.count)
+
+    def to_dict(self):
+        """
+        :return: Dict of the stats, None if no values have been added
+        """
+        if self.count == 0:
+            return None
+        stats = {'min': self.min, 'max': self.max, 'mean': self.mean, 'stdev': self.stdev(), 'count': self.count}
+        for name, quantile in self.quantiles.items():
+            stats[name] = quantile.value()
+        return stats
+
+
+class FrameStats:
+    """
+    Stats of timing results across frames, updated as each frame is read.
+    """
+
+    def __init__(self, keys=FRAME_STAT_KEYS):
+        """
+        :param keys: Timing values to keep stats of
+        """
+        self.frames = 0
+        self.failed = 0
+        # Frames where the LED band moved too far from the registration to be tracked
+        self.drifted = 0
+        self.stats = {key: RunningStats() for key in keys}
+
+    def add(self, timinginfo):
+        """
+        :param timinginfo: Timing of a frame, from read_time.readtime or a frame summary with the same keys.
+            None values, like the row time of global shutter frames, are skipped.
+        """
+        self.frames += 1
+        tracking = timinginfo.get('tracking')
+        if timinginfo.get('drift') or (tracking and tracking['drift']):
+            self.drifted += 1
+        for key, stats in self.stats.items():
+            if timinginfo.get(key) is not None:
+                stats.add(timinginfo[key])
+
+    def add_failed(self):
+        self.failed += 1
+
+    def summary(self):
+        """
+        :return: Stats of each value so far
+        :rtype: Dict
+        """
+        summary = {'frames': self.frames, 'failed': self.failed, 'drifted': self.drifted}
+        for key, stats in self.stats.items():
+            summary[key] = stats.to_dict()
+        return summary
@@ -0,0 +1,186 @@
+# Exposure Timing - NEXTA Analysis
+# Copyright (C) 2024 Russell Valentine
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+
+import numpy as np
+
+import read_time
+
+
+def make_timed_rows(first_time, row_time, count=400, first_y=1000):
+    """
+    :return: TIMED_ROW_DTYPE rows of a rolling shutter, values wrapped to NEXTA's 10s cycle and truncated to 0.1ms
+    """
+    ys = np.arange(first_y, first_y + count)
+    values = np.round((first_time + row_time * (ys - first_y)) % read_time.NEXTA_PERIOD, 4)
+    timed_rows = np.zeros(count, dtype=read_time.TIMED_ROW_DTYPE)
+    timed_rows['y'] = ys
+    timed_rows['value'] = values
+    timed_rows['decimals'] = 4
+    timed_rows['err'] = -4
+    return timed_rows
+
+
+def make_led_image(seed, shape=(200, 700), dtype=np.uint8):
+    """
+    :return: Random image and 20 LED polygons, tilted and with uneven tops like a real registration
+    """
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, shape).astype(dtype)
+    polygons = []
+    x = 20
+    for i in range(20):
+        polygons.append([[x, 40 + i % 3], [x + 14, 42], [x + 15, 160 - i % 2], [x + 1, 160 + (i == 13) * 20]])
+        x += 30 if i != 9 else 45
+    # A short seconds LED, some rows have fewer than 12 LEDs, and a short ms LED, some rows stop counting at it
+    polygons[11][0][1] = polygons[11][1][1] = 70
+    polygons[16][2][1] = polygons[16][3][1] = 130
+    return img, polygons
+
+
+def get_timing_led_rows_per_row(stretched_image, led_on_thresh, polygons):
+    """
+    Row by row LED scan the way readtime used to do it, polygons cropped to their rectangle without its last row and
+    column, see get_timing_led_matrix.
+    """
+    y_min = min(y for poly in polygons for x, y in poly)
+    y_max = max(y for poly in polygons for x, y in poly) + 1
+    timed_rows = {}
+    ms_leds_timed_cols = {12: [], 13: [], 14: [], 15: []}
+    for y in range(y_min, y_max):
+        row_led_in = 0
+        row_led_on = []
+        for roi_idx in range(len(polygons) - 1):
+            px1, py1, px2, py2, ppoly = read_time.get_poly_rectangle(polygons[roi_idx])
+            if not py1 <= y < py2:
+                break
+            row_led_in += 1
+            prect = stretched_image[py1:py2, px1:px2]
+            poly_mask = read_time.get_poly_mask(prect, ppoly)
+            pmean = prect[y - py1][poly_mask[y - py1]].mean()
+            row_led_on.append(pmean > led_on_thresh)
+            if roi_idx in ms_leds_timed_cols:
+                ms_leds_timed_cols[roi_idx].append(pmean > prect[poly_mask].mean())
+        if row_led_in >= 12:
+            timed_rows[y] = row_led_on
+    return timed_rows, ms_leds_timed_cols
+
+
+def test_timing_led_matrix_matches_row_scan():
+    for seed in range(3):
+        img, polygons = make_led_image(seed)
+        registration = read_time.Registration(polygons)
+        for y_offset in (0, 30):
+            expected, expected_ms = get_timing_led_rows_per_row(img, 127.5, polygons)
+            ys, led_on, led_counts, ms_leds_timed_cols = read_time.get_timing_led_matrix(
+                img[y_offset:], 127.5, registration, y_offset=y_offset)
+            assert ys.tolist() == list(expected.keys())
+            for y, row_on, count in zip(ys, led_on, led_counts):
+                assert row_on[:count].tolist() == expected[y]
+                assert not row_on[count:].any()
+            assert ms_leds_timed_cols == expected_ms
+
+
+NEXTA_DIGIT_STRINGS = ['0000', '0001', '0010', '0100', '1000', '0011', '0110', '1100', '0111', '1111']
+NEXTA_ERROR_STRINGS = ['00000000000000000000', '10100000000000000000', '10101000000000000000', '10101010000000000000',
+                       '10101010100000000000', '10101010101000000000']
+
+
+def decode_nexta_time_per_row(led_values, exptime):
+    """
+    One row decoded from a string of its LEDs the way readtime used to do it, see decode_nexta_times.
+    :return: None for error codes, or dict of value string, led_count, err, and lsb if a digit didn't decode
+    """
+    decoded = ''
+    best_err = int(math.log(exptime) / math.log(10))
+    sled_values = ''.join('1' if v else '0' for v in led_values).ljust(20, '0')
+    if sled_values in NEXTA_ERROR_STRINGS:
+        return None
+    for i in range(0, len(sled_values), 4):
+        nibble = sled_values[i:i + 4]
+        if nibble not in NEXTA_DIGIT_STRINGS:
+            err = max(-1 * int(len(led_values) / 4.0), -1 * i)
+            if err < best_err:
+                err = best_err
+                decoded = decoded[0:-1 * err + 2]
+            return {'value': decoded, 'err': err, 'led_count': len(led_values),
+                    'lsb': ''.join('1' if v else '0' for v in led_values[i:])}
+        decoded += str(NEXTA_DIGIT_STRINGS.index(nibble))
+        if i == 0:
+            decoded += '.'
+    err = -1 * int(len(led_values) / 4.0)
+    if err < best_err:
+        err = best_err
+    decoded = decoded[0:-1 * err + 2]
+    return {'value': decoded, 'led_count': len(led_values), 'err': err}
+
+
+def test_decode_nexta_times_matches_row_decoder():
+    rng = np.random.default_rng(0)
+    count = 4000
+    # Mostly valid digits, some nibbles garbled, LEDs past each row's count are off like get_timing_led_matrix gives
+    codes = np.array([int(d, 2) for d in NEXTA_DIGIT_STRINGS])
+    nibbles = np.where(rng.random((count, 5)) < 0.9, codes[rng.integers(0, 10, (count, 5))],
+                       rng.integers(0, 16, (count, 5)))
+    led_counts = rng.integers(12, 20, count)
+    led_on = ((nibbles[:, :, np.newaxis] >> np.arange(3, -1, -1)) & 1).reshape(count, 20).astype(bool)[:, :19]
+    led_on &= np.arange(19) < led_counts[:, np.newaxis]
+    errors = np.array([[c == '1' for c in code[:19]] for code in NEXTA_ERROR_STRINGS])
+    led_on = np.concatenate((led_on, errors))
+    led_counts = np.concatenate((led_counts, np.full(len(errors), 19)))
+    packed = read_time.pack_led_rows(led_on)
+    for exptime in (1e-5, 1e-4, 0.001, 0.01, 0.5, 1.0, 2.0, 30.0):
+        values, errs, valid, decimals, bad_digits = read_time.decode_nexta_times(packed, led_counts, exptime)
+        for i in range(len(packed)):
+            expected = decode_nexta_time_per_row(led_on[i, :led_counts[i]].tolist(), exptime)
+            if expected is None or expected['value'] == '':
+                assert not valid[i]
+                continue
+            assert valid[i]
+            row = read_time.decoded_row_to_dict(int(packed[i]), int(led_counts[i]), float(values[i]), int(errs[i]),
+                                                int(decimals[i]), int(bad_digits[i]))
+            assert row == expected
+            assert float(row['value']) == values[i]
+
+
+def test_filter_outliers_misread_seconds_digit():
+    # Seconds digit read 5s off, like 3 as 8, on one row in the middle of a band that wraps from 9s to 0s
+    for delta in (5.0, -5.0):
+        timed_rows = make_timed_rows(9.2, 0.004)
+        timed_rows['value'][200] = (timed_rows['value'][200] + delta) % read_time.NEXTA_PERIOD
+        filtered, _ = read_time.filter_outliers(timed_rows, 9.0)
+        assert len(filtered) == len(timed_rows) - 1
+        assert 1200 not in filtered['y']
+
+
+def test_unwrap_times_across_cycle():
+    timed_rows = make_timed_rows(9.9, 0.001)
+    times = read_time.unwrap_times(timed_rows['value'])
+    assert np.all(np.diff(times) > 0)
+    assert abs(times[-1] - times[0] - 0.399) < 1e-9
+
+
+def test_calculate_stats_global_ignores_ms_led_row_time():
+    # Millisecond LEDs matching noise on a global shutter frame doesn't make it rolling
+    timed_rows = make_timed_rows(9.95, 0.0)
+    stats = read_time.calculate_stats([0.0005], timed_rows, 3000, 9.9)
+    assert stats['shutter_type'] == 'GLOBAL'
+    assert stats['rolling_shutter_row_time'] is None
+    assert stats['ms_led_row_time'] == 0.0005
+    assert abs(stats['calc_first_pixel'] - 9.95005) < 1e-9
+    stats = read_time.calculate_stats([None], make_timed_rows(9.95, 0.0001), 3000, 9.9)
+    assert stats['shutter_type'] == 'ROLLING'
@@ -0,0 +1,87 @@
+# Exposure Timing - NEXTA Analysis
+# Copyright (C) 2024 Russell Valentine
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import queue
+import threading
+import tkinter
+import traceback
+
+# Virtual event that wakes the Tk loop to run queued commands
+WAKEUP_EVENT = '<<RunGUIQueue>>'
+
+
+class TkQueue:
+    """
+    Commands to run in the Tk thread, put from any thread. Putting a command wakes the Tk loop with a virtual event,
+    instead of the loop polling for commands, and each wakeup runs every command queued so far.
+    A command is a tuple of method, args and kwargs, args of None calls the method with no arguments. ('quit',) stops
+    running commands.
+    """
+
+    def __init__(self, widget):
+        """
+        :param widget: Tk widget that gets the wakeup event, usually the root
+        """
+        self.__widget = widget
+        self.__queue = queue.Queue()
+        # Set while a wakeup event is on its way, more puts before it runs don't need another
+        self.__lock = threading.Lock()
+        self.__wakeup_pending = False
+        self.__closed = False
+        widget.bind(WAKEUP_EVENT, self.__on_wakeup)
+
+    def put(self, command):
+        """
+        :param command: (method, args, kwargs) or ('quit',)
+        """
+        self.__queue.put(command)
+        with self.__lock:
+            if self.__wakeup_pending or self.__closed:
+                return
+            self.__wakeup_pending = True
+        try:
+            # Tk hands this to the Tk thread when called from another thread
+            self.__widget.event_generate(WAKEUP_EVENT, when='tail')
+        except (tkinter.TclError, RuntimeError):
+            # Window is gone, or its loop has stopped. Clear pending so a later put tries again instead of never waking
+            # the loop
+            with self.__lock:
+                self.__wakeup_pending = False
+
+    def __on_wakeup(self, event=None):
+        with self.__lock:
+            self.__wakeup_pending = False
+        while not self.__closed:
+            try:
+                command = self.__queue.get_nowait()
+            except queue.Empty:
+                break
+            self.__run(command)
+
+    def __run(self, command):
+        if command[0] == 'quit':
+            self.__closed = True
+            return
+        try:
+            method = command[0]
+            args = command[1] if len(command) > 1 else []
+            kwargs = command[2] if len(command) > 2 else {}
+            if args is not None:
+                method(*args, **kwargs)
+            else:
+                method()
+        except Exception:
+            traceback.print_exc()
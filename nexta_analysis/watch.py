@@ -0,0 +1,176 @@
+# Exposure Timing - NEXTA Analysis
+# Copyright (C) 2024 Russell Valentine
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import batch
+import read_time
+import result_store
+from running_stats import FrameStats
+
+# FITS files are made of 2880 byte blocks
+FITS_BLOCK_SIZE = 2880
+
+
+def warm_up():
+    """
+    Nothing to do, submitted to get worker processes started and initialized before frames arrive.
+    """
+    return os.getpid()
+
+
+def scan_fits_files(directory):
+    """
+    :param directory: Directory to look in
+    :return: Dict of fits filename to (size, mtime)
+    """
+    files = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in batch.FITS_EXTENSIONS:
+                stat = entry.stat()
+                files[entry.path] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+def print_frame_result(fits_filename, frame_summary, frame_stats, log_fn):
+    print(os.path.basename(fits_filename), frame_summary['shutter_type'],
+          'fits_delta:', frame_summary['fits_delta'],
+          'rolling_shutter_row_time:', frame_summary['rolling_shutter_row_time'],
+          'mean fits_delta:', frame_stats.stats['fits_delta'].mean, flush=True)
+    if frame_summary.get('drift'):
+        print('LED band moved too far from registration to track, register again', flush=True)
+    if log_fn:
+        with open(log_fn, 'a') as f:
+            f.write(json.dumps(dict(file=fits_filename, **frame_summary)) + '\n')
+
+
+def watch(registration, directory, workers=None, band_only=False, raw=False, settle_time=1.0, poll_interval=0.25,
+          existing=False, log_fn=None, verbose=0, store_path=None, track=False):
+    """
+    Reads time of new fits files in a directory as they are written, until interrupted. Prints a summary of all the
+    frames when done.
+    A file is read once its size is a whole number of FITS blocks and it has not changed for settle_time seconds.
+    :param registration: Registration, or path to a registration file
+    :param directory: Directory to watch
+    :param workers: Number of processes, defaults to number of cpus
+    :param band_only: Only read and stretch the rows of the LED band
+    :param raw: Read time without stretching
+    :param settle_time: Seconds a file's size has to stay the same before it is read
+    :param poll_interval: Seconds between directory scans
+    :param existing: Also read files already in the directory
+    :param log_fn: Append a json line for each frame to this file
+    :param verbose: How much output to print
+    :param store_path: Result store file to add timing of each frame to
+    :param track: Correct small movement of the LED band since registration
+    """
+    if not isinstance(registration, read_time.Registration):
+        registration = read_time.Registration.load(registration)
+    if not os.path.isdir(directory):
+        raise Exception('Not a directory: ' + directory)
+    if workers is None:
+        workers = os.cpu_count()
+    seen = set() if existing else set(scan_fits_files(directory).keys())
+    # filename -> (size, mtime, when it was last seen changing)
+    pending = {}
+    futures = {}
+    frame_stats = FrameStats()
+    if store_path:
+        # Create the tables before workers open it
+        result_store.ResultStore(store_path).close()
+    with ProcessPoolExecutor(max_workers=workers, initializer=batch.init_worker,
+                             initargs=(registration, band_only, raw, store_path, True, track)) as executor:
+        for future in [executor.submit(warm_up) for _ in range(workers)]:
+            future.result()
+        print('Watching', directory, flush=True)
+        try:
+            while True:
+                now = time.monotonic()
+                for fn, (size, mtime) in scan_fits_files(directory).items():
+                    if fn in seen:
+                        continue
+                    if fn not in pending or pending[fn][0:2] != (size, mtime):
+                        pending[fn] = (size, mtime, now)
+                    elif size > 0 and size % FITS_BLOCK_SIZE == 0 and now - pending[fn][2] >= settle_time:
+                        del pending[fn]
+                        seen.add(fn)
+                        futures[executor.submit(batch.process_frame, fn)] = fn
+
+                for future in [f for f in futures if f.done()]:
+                    fn = futures.pop(future)
+                    try:
+                        frame_summary = future.result()
+                        frame_stats.add(frame_summary)
+                        print_frame_result(fn, frame_summary, frame_stats, log_fn)
+                    except Exception as e:
+                        frame_stats.add_failed()
+                        print('Failed to read time:', fn, flush=True)
+                        if verbose >= 1:
+                            traceback.print_exception(e)
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print('Stopped watching', directory)
+            executor.shutdown(cancel_futures=True)
+    print(json.dumps(frame_stats.summary(), indent=4))
+
+
+def add_parser_args(parser):
+    parser.add_argument('--input', '-i', required=True, type=str,
+                        help='Directory the capture software saves FITS images to')
+    parser.add_argument('--registration', '-r', required=True, type=str,
+                        help="Path to registration file created by led_selector")
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help='Number of processes to use, defaults to number of cpus')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='Seconds a new file has to stay the same size before it is read')
+    parser.add_argument('--existing', action='store_true',
+                        help='Also read FITS images already in the directory')
+    parser.add_argument('--log', type=str, required=False, default=None,
+                        help='Append the result of each image as a json line to this file')
+    parser.add_argument('--store', type=str, required=False, default=None,
+                        help='Add time data of each image to this result store file, created if needed')
+    parser.add_argument('--band-only', action='store_true',
+                        help='Only read and stretch the rows of the image with LEDs, faster on large images. The stretch '
+                             'is from those rows only, so times can differ a little from reading the whole image')
+    parser.add_argument('--raw', action='store_true',
+                        help='Read time from the image data as is without stretching, only reads rows with LEDs')
+    parser.add_argument('--track', action='store_true',
+                        help='Follow small movement of the LED band since registration, needs a registration file with a reference')
+    parser.add_argument('--verbose', '-v', action='count', default=0,
+                        help='How much debug info, -v to print errors')
+
+
+def main(args):
+    watch(args.registration, args.input, args.workers, args.band_only, args.raw, settle_time=args.settle,
+          existing=args.existing, log_fn=args.log, verbose=args.verbose, store_path=args.store, track=args.track)
+
+
+def main_cli():
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='Watch Read Time',
+        description='Read time info from images as they are saved to a directory')
+    add_parser_args(parser)
+    args = parser.parse_args()
+    main(args)
+
+
+if __name__ == '__main__':
+    main_cli()